@@ -0,0 +1,376 @@
+"""Benchmark winsible's processing modes and transports
+
+Usage: python bench/benchmark.py [options]
+
+Runs a synthetic playbook (`--tasks` command tasks, plus a small file copy)
+against `--hosts` local SSH endpoints, once for each combination of
+processing mode and transport, and prints a table of tasks per second,
+exact p50/p99 task latency (from every task duration in winsible's own
+timing stats), SSH connections opened, and the peak RSS of any single
+process in the run.
+
+By default, the endpoints are served by an in-process paramiko server that
+accepts any credentials and runs commands (and SFTP requests) locally, as
+the current user.  Use `--sshd HOST:PORT` to use a real sshd instead (with
+key-based login for the current user), in which case each endpoint is an
+alias for the same server and connections can't be counted.
+"""
+
+import os, sys, json, time, socket, shutil, getpass, logging, tempfile
+import subprocess
+from optparse import OptionParser
+from threading import Thread
+from multiprocessing import Process, Value
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)   # run against this checkout of winsible
+
+MODES = ['fork', 'pool', 'threads', 'gevent']
+TRANSPORTS = ['_ssh', 'paramiko_pool', '_paramiko']
+
+PLAYBOOK = """
+- hosts: bench
+  gather_facts: no
+  tasks:
+%s
+    - copy: content="{{ inventory_hostname }}" dest={{ bench_dir }}/{{ inventory_hostname }}.txt
+"""
+
+TASK = "    - command: /bin/echo task %d\n"
+
+
+
+#### In-process SSH server stand-in
+
+def serve(endpoints, connections, ready):
+    """Serve SSH on `endpoints`, counting accepted connections"""
+    import paramiko
+    logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+    host_key = paramiko.RSAKey.generate(1024)
+
+    class Server(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'password,publickey'
+        def check_auth_password(self, username, password):
+            return paramiko.AUTH_SUCCESSFUL
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+        def check_channel_pty_request(self, *args):
+            return True
+        def check_channel_exec_request(self, channel, command):
+            Thread(target=run_command, args=(channel, command)).start()
+            return True
+
+    def run_command(channel, command):
+        proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        def feed():
+            while True:
+                data = channel.recv(32768)
+                if not data:
+                    break
+                proc.stdin.write(data)
+            proc.stdin.close()
+        def pump(src, send):
+            for data in iter(lambda: os.read(src.fileno(), 32768), ''):
+                try:
+                    send(data)
+                except socket.error:
+                    pass    # client went away; just drain the output
+        threads = [Thread(target=feed),
+                   Thread(target=pump, args=(proc.stdout, channel.sendall)),
+                   Thread(target=pump, args=(proc.stderr, channel.sendall_stderr))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads[1:]:
+            t.join()
+        channel.send_exit_status(proc.wait())
+        channel.close()
+
+    def handle(sock):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, LocalSFTP)
+        try:
+            transport.start_server(server=Server())
+        except (paramiko.SSHException, EOFError, socket.error):
+            transport.close()   # e.g. no common key exchange algorithm
+
+    def listen(addr, port):
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((addr, port))
+        listener.listen(100)
+        ready.value += 1
+        while True:
+            sock, addr = listener.accept()
+            with connections.get_lock():
+                connections.value += 1
+            Thread(target=handle, args=(sock,)).start()
+
+    LocalSFTP = local_sftp(paramiko)
+    for endpoint in endpoints:
+        t = Thread(target=listen, args=endpoint)
+        t.daemon = True
+        t.start()
+    while True:
+        time.sleep(60)
+
+def local_sftp(paramiko):
+    """Return an SFTPServerInterface class serving the local filesystem"""
+    from paramiko import SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+
+    class Handle(SFTPHandle):
+        def stat(self):
+            try:
+                return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+            except OSError, e:
+                return SFTPServer.convert_errno(e.errno)
+
+    def errors(method):
+        def wrapper(*args):
+            try:
+                return method(*args)
+            except (IOError, OSError), e:
+                return SFTPServer.convert_errno(e.errno)
+        return wrapper
+
+    class LocalSFTP(paramiko.SFTPServerInterface):
+        canonicalize = staticmethod(os.path.abspath)
+
+        @errors
+        def open(self, path, flags, attr):
+            fd = os.open(path, flags | getattr(os, 'O_BINARY', 0), 0o644)
+            mode = 'rb' if flags & (os.O_WRONLY|os.O_RDWR) == 0 else \
+                'ab' if flags & os.O_APPEND else \
+                'r+b' if flags & os.O_RDWR else 'wb'
+            handle = Handle(flags)
+            handle.filename = path
+            handle.readfile = handle.writefile = os.fdopen(fd, mode)
+            return handle
+
+        @errors
+        def list_folder(self, path):
+            return [
+                SFTPAttributes.from_stat(os.lstat(os.path.join(path, f)), f)
+                for f in os.listdir(path)
+            ]
+
+        @errors
+        def stat(self, path):
+            return SFTPAttributes.from_stat(os.stat(path))
+
+        @errors
+        def lstat(self, path):
+            return SFTPAttributes.from_stat(os.lstat(path))
+
+        @errors
+        def remove(self, path):
+            os.remove(path)
+            return SFTP_OK
+
+        @errors
+        def rename(self, old, new):
+            os.rename(old, new)
+            return SFTP_OK
+
+        @errors
+        def mkdir(self, path, attr):
+            os.mkdir(path)
+            return SFTP_OK
+
+        @errors
+        def rmdir(self, path):
+            os.rmdir(path)
+            return SFTP_OK
+
+        @errors
+        def chattr(self, path, attr):
+            if attr.st_mode is not None:
+                os.chmod(path, attr.st_mode)
+            return SFTP_OK
+
+    return LocalSFTP
+
+
+
+#### Benchmark runs
+
+def peak_rss_command(cmd):
+    """Wrap `cmd` to print its peak single-process RSS (KB) to stderr"""
+    return [sys.executable, '-c',
+        'import sys, subprocess, resource; rc = subprocess.call(sys.argv[1:]); '
+        'sys.stderr.write("PEAK_RSS %d\\n" % '
+        'resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss); sys.exit(rc)'
+    ] + cmd
+
+def task_latencies(stats_file):
+    """Return exact (p50, p99) task latency in ms, from a winsible stats file"""
+    from winsible.stats import exact
+    with open(stats_file) as f:
+        tasks = json.load(f).get('task', {})
+    samples = [s for entry in tasks.values() for s in entry['samples']]
+    return exact(samples, .5), exact(samples, .99)
+
+def ssh_args():
+    """OpenSSH options for the benchmark, incl. any needed for paramiko"""
+    args = ('-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null '
+            '-o ControlMaster=auto -o ControlPersist=60s')
+    # Newer OpenSSH releases disable the algorithms older paramikos offer
+    legacy = ('-o KexAlgorithms=+diffie-hellman-group14-sha1 '
+              '-o HostKeyAlgorithms=+ssh-rsa -o PubkeyAcceptedAlgorithms=+ssh-rsa')
+    with open(os.devnull, 'w') as null:
+        if not subprocess.call(['ssh', '-G'] + legacy.split() + ['localhost'],
+                               stdout=null, stderr=null):
+            args += ' ' + legacy
+    return args
+
+def loopback(i):
+    """A distinct loopback address for the i'th endpoint (Linux-only)"""
+    return '127.0.%d.%d' % divmod(i + 2, 256)
+
+def run(opts, workdir, mode, transport, connections):
+    """Run the playbook once; return a dict of results (or None on failure)"""
+    stats_file = os.path.join(workdir, 'stats-%s-%s.json' % (mode, transport))
+    control_dir = os.path.join(workdir, 'cp-%s-%s' % (mode, transport))
+    os.mkdir(control_dir)   # don't reuse a previous run's ssh masters
+    env = dict(os.environ,
+        ANSIBLE_PROCESS_MODE=mode, ANSIBLE_HOST_KEY_CHECKING='False',
+        ANSIBLE_SSH_ARGS=opts.ssh_args,
+        ANSIBLE_SSH_CONTROL_PATH=os.path.join(control_dir, '%%h-%%p'),
+        WINSIBLE_STATS=stats_file, WINSIBLE_STATS_SAMPLES='1',
+        PYTHONPATH=os.pathsep.join([ROOT] + filter(None, [
+            os.environ.get('PYTHONPATH')
+        ])),
+    )
+    cmd = [sys.executable, '-c', 'import winsible; winsible.winsible_playbook()',
+        os.path.join(workdir, 'bench.yml'),
+        '-i', os.path.join(workdir, 'hosts'), '-f', str(opts.forks),
+        '-c', transport, '-u', getpass.getuser(),
+        '--private-key', os.path.join(workdir, 'id_rsa'),
+    ]
+    if connections is not None:
+        connections.value = 0
+    start = time.time()
+    proc = subprocess.Popen(peak_rss_command(cmd), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    elapsed = time.time() - start
+    if proc.returncode:
+        if opts.verbose:
+            sys.stderr.write(out + err)
+        return None
+    p50, p99 = task_latencies(stats_file)
+    return dict(
+        mode=mode, transport=transport, seconds=elapsed,
+        tasks_per_sec=opts.hosts * (opts.tasks + 1) / elapsed,
+        p50_ms=p50, p99_ms=p99,
+        connections=connections.value if connections is not None else None,
+        peak_rss_kb=int(err.rsplit('PEAK_RSS ', 1)[1].split()[0]),
+    )
+
+def available(mode):
+    """Can `mode` run here?"""
+    if mode != 'gevent':
+        return True
+    try:
+        __import__('gevent')
+    except ImportError:
+        return False
+    return True
+
+def main():
+    parser = OptionParser(
+        usage='%prog [options]', description=__doc__.split('\n\n')[2]
+    )
+    parser.add_option('--hosts', type='int', default=10,
+        help='number of SSH endpoints (default 10)')
+    parser.add_option('--tasks', type='int', default=10,
+        help='command tasks per host (default 10)')
+    parser.add_option('--forks', type='int', default=5,
+        help='ansible forks (default 5)')
+    parser.add_option('--modes', default=','.join(MODES),
+        help='comma-separated processing modes (default: all)')
+    parser.add_option('--transports', default=','.join(TRANSPORTS),
+        help='comma-separated transports (default: %default)')
+    parser.add_option('--base-port', type='int', default=22200,
+        help='first port for the in-process server (default %default)')
+    parser.add_option('--sshd', help='use a real sshd, e.g. localhost:22')
+    parser.add_option('--json', help='also write results to this file')
+    parser.add_option('-v', '--verbose', action='store_true',
+        help='show the output of failed runs')
+    opts, args = parser.parse_args()
+    opts.ssh_args = ssh_args()
+
+    import paramiko
+    workdir = tempfile.mkdtemp(prefix='winsible-bench-')
+    server = connections = None
+    try:
+        key = paramiko.RSAKey.generate(2048)
+        key.write_private_key_file(os.path.join(workdir, 'id_rsa'))
+        os.chmod(os.path.join(workdir, 'id_rsa'), 0o600)
+
+        if opts.sshd:
+            addr, port = opts.sshd.rsplit(':', 1)
+            endpoints = [(addr, int(port))] * opts.hosts
+        else:
+            endpoints = [
+                (loopback(i), opts.base_port + i) for i in range(opts.hosts)
+            ]
+            connections, ready = Value('i', 0), Value('i', 0)
+            server = Process(target=serve, args=(endpoints, connections, ready))
+            server.daemon = True
+            server.start()
+            while ready.value < len(endpoints):
+                time.sleep(.1)
+
+        with open(os.path.join(workdir, 'hosts'), 'w') as f:
+            f.write('[bench]\n')
+            for i, (addr, port) in enumerate(endpoints):
+                f.write('bench-%03d ansible_ssh_host=%s ansible_ssh_port=%d\n'
+                        % (i, addr, port))
+            f.write('[bench:vars]\nbench_dir=%s\n' % workdir)
+            f.write('ansible_python_interpreter=%s\n' % sys.executable)
+        with open(os.path.join(workdir, 'bench.yml'), 'w') as f:
+            f.write(PLAYBOOK % ''.join(TASK % i for i in range(opts.tasks)))
+
+        header = '%-8s %-14s %8s %9s %8s %8s %6s %10s' % (
+            'mode', 'transport', 'secs', 'tasks/s', 'p50(ms)', 'p99(ms)',
+            'conns', 'rss(KB)'
+        )
+        print header
+        results = []
+        for mode in opts.modes.split(','):
+            if not available(mode):
+                print '%-8s (not available)' % mode
+                continue
+            for transport in opts.transports.split(','):
+                res = run(opts, workdir, mode, transport, connections)
+                if res is None:
+                    print '%-8s %-14s (failed; use -v for output)' % (
+                        mode, transport
+                    )
+                    continue
+                results.append(res)
+                print '%-8s %-14s %8.2f %9.1f %8.1f %8.1f %6s %10d' % (
+                    mode, transport, res['seconds'], res['tasks_per_sec'],
+                    res['p50_ms'], res['p99_ms'],
+                    '-' if res['connections'] is None else res['connections'],
+                    res['peak_rss_kb']
+                )
+        if opts.json:
+            with open(opts.json, 'w') as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+        if server is not None:
+            server.terminate()
+        shutil.rmtree(workdir, True)
+
+if __name__ == '__main__':
+    main()
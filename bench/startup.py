@@ -0,0 +1,76 @@
+"""Benchmark winsible's startup time
+
+Usage: python bench/startup.py [options]
+
+Times `--runs` fresh Python processes for each of several startup steps:
+importing winsible, `winsible --version` (which finds and runs ansible's own
+script, importing ansible along the way) in the default and `pool` modes,
+and for comparison, ansible's own `ansible --version` and a bare import of
+`pkg_resources` (which older winsible versions used to find ansible's
+scripts and check for gevent).  Prints the best and median times of each.
+"""
+
+import os, sys, json, time, subprocess
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)   # run against this checkout of winsible
+
+CASES = [
+    ('python', 'pass', None),
+    ('pkg_resources', 'import pkg_resources', None),
+    ('import winsible', 'import winsible', None),
+    ('winsible --version', 'import winsible; winsible.winsible()', None),
+    ('  (pool mode)', 'import winsible; winsible.winsible()', 'pool'),
+    ('ansible --version', None, None),
+]
+
+def command(code):
+    """Return a command line that runs `code`, or the stock ansible script"""
+    if code is not None:
+        return [sys.executable, '-c', code, '--version']
+    import winsible
+    return [sys.executable, winsible.find_script('ansible'), '--version']
+
+def time_runs(cmd, mode, runs):
+    """Return the wall-clock seconds of `runs` runs of `cmd`"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [ROOT, os.environ.get('PYTHONPATH')])
+    ))
+    env.pop('ANSIBLE_PROCESS_MODE', None)
+    if mode:
+        env['ANSIBLE_PROCESS_MODE'] = mode
+    times = []
+    with open(os.devnull, 'w') as null:
+        for i in range(runs):
+            start = time.time()
+            subprocess.check_call(
+                cmd, env=env, cwd=ROOT, stdout=null, stderr=null
+            )
+            times.append(time.time() - start)
+    return sorted(times)
+
+def main():
+    parser = OptionParser(
+        usage='%prog [options]', description=__doc__.split('\n\n')[2]
+    )
+    parser.add_option('--runs', type='int', default=10,
+        help='processes to time for each step (default %default)')
+    parser.add_option('--json', help='also write results to this file')
+    opts, args = parser.parse_args()
+
+    print '%-22s %9s %9s' % ('step', 'best(ms)', 'p50(ms)')
+    results = []
+    for name, code, mode in CASES:
+        times = time_runs(command(code), mode, opts.runs)
+        results.append(dict(
+            step=name.strip(), mode=mode, best_ms=times[0] * 1000,
+            p50_ms=times[len(times) // 2] * 1000
+        ))
+        print '%-22s %9d %9d' % (name, times[0] * 1000, times[len(times) // 2] * 1000)
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -16,14 +16,14 @@ setup(
     keywords = "ansible ssh cygwin",
     url = "https://github.com/pjeby/winsible",
 
-    package_data = {'winsible':['*.exe', 'sessions/*']},
+    package_data = {'winsible':['*.exe', 'sessions/*', 'callbacks/*.py']},
     include_package_data = True,
     zip_safe = False,    # .exe's have to be run
     
     install_requires = [
         'ansible >= 1.8.4', 'Importing >= 1.10', 'cachetools >= 1.0',
         'paramiko>=1.15.2',
-        'setuptools',   # used for pkg_resources calls at runtime 
+        'setuptools',   # pkg_resources is a fallback for finding scripts
     ],
     extras_require = dict(gevent = ['gevent >= 1.0.1']),
     
@@ -0,0 +1,69 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import unittest
+from winsible import adaptive
+from winsible.adaptive import Controller, WINDOW
+
+
+class Measured(Controller):
+    """A Controller whose CPU use and cache hit rate are set by the test"""
+    cpu, hit_rate = 0.1, 1.0
+    def measure(self):
+        return self.cpu, self.hit_rate
+
+class ControllerTests(unittest.TestCase):
+
+    def finish(self, control, n=WINDOW, seconds=1.0, backlog=True):
+        for i in range(n):
+            limit = control.done(seconds, backlog)
+        return limit
+
+    def test_bounds(self):
+        self.assertEqual(adaptive.bounds('64'), (1, 64))
+        self.assertEqual(adaptive.bounds(' 4:64 '), (4, 64))
+        for spec in ('0', '8:4', '0:4', 'x', ''):
+            self.assertRaises(ValueError, adaptive.bounds, spec)
+
+    def test_starts_within_bounds(self):
+        self.assertEqual(Measured(4, 64, 1).limit, 4)
+        self.assertEqual(Measured(4, 64, 100).limit, 64)
+        self.assertEqual(Measured(4, 64, 10).limit, 10)
+
+    def test_grows_while_hosts_wait_and_there_is_room(self):
+        control = Measured(4, 20, 8)
+        self.assertEqual(self.finish(control), 10)
+        self.assertEqual(self.finish(control, 10), 12)
+        for i in range(10):
+            self.finish(control, control.limit)
+        self.assertEqual(control.limit, 20)
+        self.assertEqual(control.levels[:3], [8, 10, 12])
+
+    def test_holds_without_a_backlog(self):
+        control = Measured(4, 20, 8)
+        self.assertEqual(self.finish(control, backlog=False), 8)
+
+    def test_shrinks_when_overloaded(self):
+        control = Measured(4, 20, 16)
+        control.cpu = 0.95
+        self.assertEqual(self.finish(control, 16), 12)
+        for i in range(10):
+            self.finish(control, control.limit)
+        self.assertEqual(control.limit, 4)
+
+    def test_shrinks_on_cache_misses_and_slower_tasks(self):
+        control = Measured(4, 20, 16)
+        control.hit_rate = 0.5
+        self.assertEqual(self.finish(control, 16), 12)
+        control.hit_rate = 1.0
+        self.assertEqual(self.finish(control, 12, seconds=2.0), 9)
+
+    def test_new_tasks_get_a_new_baseline(self):
+        control = Measured(4, 20, 8)
+        self.finish(control)
+        control.begin()
+        self.assertEqual(self.finish(control, 10, seconds=5.0), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
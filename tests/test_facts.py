@@ -0,0 +1,107 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import os, shutil, tempfile, unittest, subprocess
+from winsible import facts
+
+
+class FactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = facts.PATH, facts.TTL
+        facts.PATH = os.path.join(self.dir, 'sub', 'facts.cache')
+        facts.TTL = 60
+        self.reset()
+
+    def tearDown(self):
+        if hasattr(facts.data, 'close'):
+            facts.data.close()
+        facts.PATH, facts.TTL = self.saved
+        self.reset()
+        shutil.rmtree(self.dir)
+
+    def reset(self):
+        """Forget everything, as if in a new process"""
+        facts.index, facts.data, facts.base = None, '', 0
+        facts.updates.clear()
+
+    def test_round_trip(self):
+        facts.store('a', {'ansible_os_family': 'Debian'}, 'fp-a')
+        facts.store('b', {'ansible_os_family': 'RedHat'}, 'fp-b')
+        facts.save()
+        self.reset()
+        self.assertEqual(facts.get('a', 'fp-a'),
+                         {'ansible_os_family': 'Debian'})
+        self.assertEqual(facts.get('b', 'fp-b'),
+                         {'ansible_os_family': 'RedHat'})
+
+    def test_fingerprint_must_match(self):
+        facts.store('a', {'x': 1}, 'fp-a')
+        facts.save()
+        self.reset()
+        self.assertIsNone(facts.get('a', 'rebooted'))
+        self.assertIsNone(facts.get('a', ''))
+        self.assertIsNone(facts.get('unknown', 'fp-a'))
+
+    def test_expires_after_ttl(self):
+        facts.store('a', {'x': 1}, 'fp-a')
+        facts.save()
+        self.reset()
+        facts.TTL = -1
+        self.assertIsNone(facts.get('a', 'fp-a'))
+
+    def test_save_merges_with_other_runs(self):
+        facts.store('a', {'x': 1}, 'fp-a')
+        facts.save()
+        self.reset()
+        facts.store('b', {'x': 2}, 'fp-b')
+        facts.store('a', {'x': 3}, 'fp-a2')
+        facts.save()
+        self.reset()
+        self.assertEqual(facts.get('a', 'fp-a2'), {'x': 3})
+        self.assertIsNone(facts.get('a', 'fp-a'))
+        self.assertEqual(facts.get('b', 'fp-b'), {'x': 2})
+
+    def test_save_drops_expired_entries(self):
+        facts.store('old', {'x': 1}, 'fp')
+        facts.updates['old'] = facts.updates['old'][:2] + (0,)  # saved in 1970
+        facts.store('new', {'x': 2}, 'fp')
+        facts.save()
+        facts.store('newer', {'x': 3}, 'fp')
+        facts.save()
+        self.assertEqual(sorted(facts.index), ['new', 'newer'])
+
+    def test_replaces_a_corrupt_file(self):
+        os.makedirs(os.path.dirname(facts.PATH))
+        with open(facts.PATH, 'wb') as f:
+            f.write(facts.MAGIC + '\xff\xff\xff\xffgarbage')
+        self.assertIsNone(facts.get('a', 'fp'))
+        facts.store('a', {'x': 1}, 'fp')
+        facts.save()
+        self.reset()
+        self.assertEqual(facts.get('a', 'fp'), {'x': 1})
+
+    def test_reloading_unmaps_the_old_file(self):
+        facts.store('a', {'x': 1}, 'fp')
+        facts.save()
+        old = facts.data
+        facts.load()
+        self.assertRaises(ValueError, old.__getitem__, 0)   # closed
+        self.assertEqual(facts.get('a', 'fp'), {'x': 1})
+
+    def test_fingerprint_sees_rpm_updates_in_place(self):
+        root = os.path.join(self.dir, 'rpm')
+        packages = os.path.join(root, 'Packages')
+        os.mkdir(root)
+        open(packages, 'w').close()
+        command = facts.FINGERPRINT.replace('/var/lib/', self.dir + '/')
+        def fingerprint(mtime):
+            os.utime(packages, (mtime, mtime))
+            os.utime(root, (1, 1))  # the directory itself doesn't change
+            return subprocess.check_output(['sh', '-c', command])
+        self.assertNotEqual(fingerprint(1000), fingerprint(2000))
+
+
+if __name__ == '__main__':
+    unittest.main()
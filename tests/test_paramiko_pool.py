@@ -0,0 +1,321 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import os, time, shutil, tempfile, unittest, paramiko
+from threading import Thread
+from winsible import paramiko_pool, plan, adaptive
+from winsible.paramiko_pool import ConnectionCache, HostPool, HostKeyStore
+from winsible.paramiko_pool import is_alive
+
+
+class Transport(object):
+    active, delay = True, 0
+    def is_active(self):
+        return self.active
+    def global_request(self, *args, **kw):
+        time.sleep(self.delay)  # how long the server takes to answer
+    def close(self):
+        self.active = False
+
+class SFTP(object):
+    closed = False
+    def __init__(self):
+        self.sock = self
+    def close(self):
+        self.closed = True
+
+class Client(object):
+    def __init__(self):
+        self.transport = Transport()
+    def get_transport(self):
+        return self.transport
+    def open_sftp(self):
+        return SFTP()
+    def close(self):
+        self.transport.close()
+    @property
+    def closed(self):
+        return not self.transport.active
+
+class Runner(object):
+    timeout = 1
+
+class Connection(object):
+    def __init__(self, host):
+        self.host, self.port, self.user = host, 22, 'user'
+        self.runner = Runner()
+        self.opened = []
+    def _connect_uncached(self):
+        self.opened.append(Client())
+        return self.opened[-1]
+
+class Settings(object):
+    """Temporarily change paramiko_pool settings"""
+    def __init__(self, **settings):
+        self.settings = settings
+    def __enter__(self):
+        self.saved = dict(
+            (name, getattr(paramiko_pool, name)) for name in self.settings
+        )
+        for name, value in self.settings.items():
+            setattr(paramiko_pool, name, value)
+    def __exit__(self, *exc):
+        for name, value in self.saved.items():
+            setattr(paramiko_pool, name, value)
+
+
+class ConnectionCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ConnectionCache(2, 60)
+        self.clients = {}
+
+    def tearDown(self):
+        plan.update([])
+
+    def use(self, host):
+        """Check out and return a connection to `host`; return its client"""
+        conn = Connection(host)
+        pool, client = self.cache.checkout(conn)
+        self.cache.checkin(conn, pool, client)
+        self.clients.setdefault(host, client)
+        return client
+
+    def hosts(self):
+        return [key[0] for key in self.cache.pools]
+
+    def test_reuses_connections(self):
+        self.assertIs(self.use('a'), self.use('a'))
+        self.assertEqual(self.hosts(), ['a'])
+
+    def test_evicts_least_recently_used(self):
+        self.use('a'); self.use('b'); self.use('a'); self.use('c')
+        self.assertEqual(self.hosts(), ['a', 'c'])
+        self.assertTrue(self.clients['b'].closed)
+        self.assertFalse(self.clients['a'].closed)
+
+    def test_evicts_hosts_outside_the_batch_first(self):
+        plan.update(['a', 'c'])
+        self.use('a'); self.use('b'); self.use('c')
+        self.assertEqual(self.hosts(), ['a', 'c'])
+        self.assertTrue(self.clients['b'].closed)
+
+    def test_never_evicts_pools_in_use(self):
+        held = [Connection('a'), Connection('b')]
+        checkouts = [self.cache.checkout(conn) for conn in held]
+        self.use('c')
+        self.assertEqual(self.hosts(), ['a', 'b', 'c'])
+        for conn, (pool, client) in zip(held, checkouts):
+            self.assertFalse(client.closed)
+            self.cache.checkin(conn, pool, client)
+        self.use('d')   # now the excess can go (c, then a, were used last)
+        self.assertEqual(self.hosts(), ['b', 'd'])
+
+    def test_expires_idle_pools(self):
+        self.use('a')
+        self.cache.pools.values()[0].last_used -= 61
+        self.use('b')
+        self.assertEqual(self.hosts(), ['b'])
+        self.assertTrue(self.clients['a'].closed)
+
+    def test_counts_reconnects_after_eviction_as_misses(self):
+        before = dict(adaptive.counts)
+        self.use('a'); self.use('b'); self.use('c')     # evicts a
+        self.use('a')
+        self.assertEqual(adaptive.counts['misses'] - before['misses'], 1)
+        self.use('a')
+        self.assertEqual(adaptive.counts['hits'] - before['hits'], 1)
+
+    def test_replan_drops_unreachable_hosts(self):
+        self.use('a'); self.use('b')
+        plan.update(['a', 'b'], ['b'])
+        self.cache.replan()
+        self.assertEqual(self.hosts(), ['a'])
+        self.assertTrue(self.clients['b'].closed)
+
+    def test_replan_keeps_unreachable_pools_in_use(self):
+        conn = Connection('b')
+        pool, client = self.cache.checkout(conn)
+        plan.update(['b'], ['b'])
+        self.cache.replan()
+        self.assertEqual(self.hosts(), ['b'])
+        self.cache.checkin(conn, pool, client)
+
+    def test_replan_shrinks_to_capacity(self):
+        self.cache.maxsize = 3
+        self.use('a'); self.use('b'); self.use('c')
+        self.cache.maxsize = 1
+        self.cache.replan()
+        self.assertEqual(self.hosts(), ['c'])
+
+    def test_auto_size(self):
+        self.assertEqual(paramiko_pool.auto_size(5, 0), 50)
+        self.assertEqual(paramiko_pool.auto_size(5, 3), 10)
+        self.assertEqual(paramiko_pool.auto_size(5, 30), 30)
+        self.cache.maxsize = 'auto'
+        plan.update([], (), 30, 5)
+        self.assertEqual(self.cache.capacity(), 30)
+
+
+class HostPoolTests(unittest.TestCase):
+
+    def test_shares_a_client_between_channels(self):
+        pool, conn = HostPool(), Connection('a')
+        first, second = pool.checkout(conn), pool.checkout(conn)
+        self.assertIs(first, second)
+        self.assertEqual(pool.clients[first], 2)
+        pool.checkin(first); pool.checkin(second)
+        self.assertEqual(pool.clients[first], 0)
+        self.assertEqual(len(conn.opened), 1)
+
+    def test_opens_another_client_when_channels_run_out(self):
+        pool, conn = HostPool(), Connection('a')
+        clients = [
+            pool.checkout(conn) for i in range(paramiko_pool.MAX_CHANNELS + 1)
+        ]
+        self.assertEqual(len(set(clients)), 2)
+
+    def test_shares_past_the_transport_cap_after_the_timeout(self):
+        pool, conn = HostPool(), Connection('a')
+        conn.runner.timeout = .2
+        with Settings(MAX_CHANNELS=1, MAX_TRANSPORTS=1):
+            first = pool.checkout(conn)
+            start = time.time()
+            self.assertIs(pool.checkout(conn), first)
+        self.assertTrue(time.time() - start >= .2)
+        self.assertEqual(len(conn.opened), 1)
+
+    def test_counts_sftp_sessions_as_channels(self):
+        pool, conn = HostPool(), Connection('a')
+        with Settings(MAX_CHANNELS=2):
+            client = pool.checkout(conn)
+            pool.checkout_sftp(client)
+            self.assertIsNot(pool.checkout(conn), client)
+
+    def test_closes_idle_sftp_sessions_to_free_channels(self):
+        pool, conn = HostPool(), Connection('a')
+        with Settings(MAX_CHANNELS=2):
+            client = pool.checkout(conn)
+            sftp = pool.checkout_sftp(client)
+            pool.checkin_sftp(client, sftp)
+            self.assertEqual(pool.clients[client], 2)   # idle, but open
+            self.assertIs(pool.checkout_sftp(client), sftp)
+            pool.checkin_sftp(client, sftp)
+            self.assertIs(pool.checkout(conn), client)
+        self.assertTrue(sftp.closed)
+        self.assertEqual(pool.clients[client], 2)
+        self.assertEqual(len(conn.opened), 1)
+
+
+class HealthCheckTests(unittest.TestCase):
+
+    def test_replaces_dead_clients(self):
+        pool, conn = HostPool(), Connection('a')
+        client = pool.checkout(conn)
+        pool.checkin(client)
+        client.close()
+        self.assertIsNot(pool.checkout(conn), client)
+        self.assertNotIn(client, pool.clients)
+
+    def test_unanswered_probes_close_the_transport(self):
+        client = Client()
+        client.transport.delay = 1
+        with Settings(PROBE_TIMEOUT=.1):
+            self.assertFalse(is_alive(client))
+        self.assertTrue(client.closed)
+        self.assertTrue(is_alive(Client()))
+
+    def test_probes_dont_hold_up_checkins(self):
+        pool, conn = HostPool(), Connection('a')
+        with Settings(MAX_CHANNELS=1):
+            idle, busy = pool.checkout(conn), pool.checkout(conn)
+        pool.checkin(idle)
+        pool.touched[idle] = 0  # due for a probe
+        idle.transport.delay = .5
+        prober = Thread(target=pool.checkout, args=(conn,))
+        prober.start()
+        time.sleep(.1)
+        start = time.time()
+        pool.checkin(busy)
+        self.assertTrue(time.time() - start < .2)
+        prober.join()
+        self.assertEqual(pool.clients[idle], 1)
+
+    def test_sweeps_dont_revive_expired_pools(self):
+        cache, conn = ConnectionCache(10, 60), Connection('a')
+        pool, client = cache.checkout(conn)
+        cache.checkin(conn, pool, client)
+        pool.last_used -= 61
+        pool.touched[client] = 0
+        cache.sweep(1)
+        self.assertEqual(len(cache.pools), 0)
+        self.assertTrue(client.closed)
+
+    def test_sweeps_keep_live_pools_until_the_keepalive_ttl(self):
+        cache, conn = ConnectionCache(10, 60), Connection('a')
+        pool, client = cache.checkout(conn)
+        cache.checkin(conn, pool, client)
+        with Settings(KEEPALIVE_TTL=600):
+            pool.last_used -= 59
+            cache.sweep(1)
+            pool.last_used -= 500   # e.g. between plays
+            cache.sweep(1)
+            self.assertEqual(len(cache.pools), 1)
+            self.assertFalse(client.closed)
+            pool.last_used -= 100
+            cache.sweep(1)
+        self.assertEqual(len(cache.pools), 0)
+        self.assertTrue(client.closed)
+
+
+class HostKeyStoreTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [paramiko.RSAKey.generate(1024) for i in range(2)]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = (paramiko_pool.KNOWN_HOSTS, C.HOST_KEY_CHECKING,
+                      C.PARAMIKO_RECORD_HOST_KEYS)
+        paramiko_pool.KNOWN_HOSTS = os.path.join(self.dir, 'known_hosts')
+        C.HOST_KEY_CHECKING = C.PARAMIKO_RECORD_HOST_KEYS = True
+        self.store = HostKeyStore()
+        self.store.added = paramiko.HostKeys()
+
+    def tearDown(self):
+        (paramiko_pool.KNOWN_HOSTS, C.HOST_KEY_CHECKING,
+         C.PARAMIKO_RECORD_HOST_KEYS) = self.saved
+        shutil.rmtree(self.dir)
+
+    def lines(self):
+        with open(paramiko_pool.KNOWN_HOSTS) as f:
+            return f.read().splitlines()
+
+    def test_appends_new_keys_once(self):
+        old, new = self.keys
+        with open(paramiko_pool.KNOWN_HOSTS, 'w') as f:
+            f.write('old ssh-rsa %s' % old.get_base64())    # no newline
+        self.store.added.add('old', 'ssh-rsa', old)
+        self.store.added.add('new', 'ssh-rsa', new)
+        self.store.save()
+        self.store.save()
+        self.assertEqual(self.lines(), [
+            'old ssh-rsa %s' % old.get_base64(),
+            'new ssh-rsa %s' % new.get_base64(),
+        ])
+
+    def test_creates_known_hosts(self):
+        self.store.added.add('new', 'ssh-rsa', self.keys[0])
+        self.store.save()
+        self.assertEqual(len(self.lines()), 1)
+
+    def test_saves_nothing_unless_recording(self):
+        C.PARAMIKO_RECORD_HOST_KEYS = False
+        self.store.added.add('new', 'ssh-rsa', self.keys[0])
+        self.store.save()
+        self.assertFalse(os.path.exists(paramiko_pool.KNOWN_HOSTS))
+
+
+if __name__ == '__main__':
+    unittest.main()
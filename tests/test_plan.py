@@ -0,0 +1,25 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import unittest
+from winsible import plan
+
+
+class PlanTests(unittest.TestCase):
+
+    def tearDown(self):
+        plan.update([])
+
+    def test_update_notifies_listeners(self):
+        seen = []
+        plan.listeners.append(lambda: seen.append(plan.current()))
+        try:
+            plan.update(['b', 'a'], ['b'], 10, 5)
+        finally:
+            plan.listeners.pop()
+        self.assertEqual(seen, [(['a', 'b'], ['b'], 10, 5)])
+        self.assertEqual(plan.batch, frozenset(['a', 'b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
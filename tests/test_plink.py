@@ -0,0 +1,249 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import os, hmac, shutil, signal, tempfile, unittest
+from StringIO import StringIO
+from base64 import b64encode
+from hashlib import sha1
+from winsible import plink
+from winsible.plink import KnownHosts, PathTranslator, Channel, CHUNK
+from winsible.plink import key_fingerprint
+
+KEYS = [b64encode('key %d' % i) for i in range(6)]
+FPS = [key_fingerprint('key %d' % i) for i in range(6)]
+
+def hashed(host, salt='0123456789abcdefghij'):
+    digest = hmac.new(salt, host, sha1).digest()
+    return '|1|%s|%s' % (b64encode(salt), b64encode(digest))
+
+
+class KnownHostsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, name) for name in 'ab']
+        self.cache = os.path.join(self.dir, 'cache', 'known_hosts.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, *lines):
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def known_hosts(self):
+        return KnownHosts(self.paths, self.cache)
+
+    def test_fingerprint_format(self):
+        self.assertRegexpMatches(FPS[0], '^([0-9a-f]{2}:){15}[0-9a-f]{2}$')
+
+    def test_plain_hashed_and_wildcard_entries(self):
+        self.write(self.paths[0],
+            '# a comment',
+            'alpha,10.0.0.1 ssh-rsa ' + KEYS[0],
+            hashed('beta') + ' ssh-rsa ' + KEYS[1],
+            '*.example.com,!bad.example.com ssh-rsa ' + KEYS[2],
+            '[gamma]:2222 ssh-rsa ' + KEYS[3],
+            '@revoked alpha ssh-rsa ' + KEYS[4],
+            'broken ssh-rsa !!!notbase64',
+        )
+        hosts = self.known_hosts()
+        self.assertEqual(hosts['alpha'], FPS[0])
+        self.assertEqual(hosts['10.0.0.1'], FPS[0])
+        self.assertEqual(hosts['beta'], FPS[1])
+        self.assertEqual(hosts['good.example.com'], FPS[2])
+        self.assertIsNone(hosts['bad.example.com'])
+        self.assertEqual(hosts['[gamma]:2222'], FPS[3])
+        self.assertIsNone(hosts['gamma'])
+        self.assertIsNone(hosts['broken'])
+
+    def test_skips_malformed_hashed_entries(self):
+        self.write(self.paths[0],
+            '|1|nodigest ssh-rsa ' + KEYS[0],
+            '|1|too|many|fields ssh-rsa ' + KEYS[0],
+            '|1|abc|de ssh-rsa ' + KEYS[0],
+            hashed('beta') + ' ssh-rsa ' + KEYS[1],
+        )
+        hosts = self.known_hosts()
+        self.assertEqual(hosts['beta'], FPS[1])
+        self.assertEqual(len(hosts.hashed), 1)
+
+    def test_first_matching_entry_wins(self):
+        self.write(self.paths[0],
+            hashed('alpha') + ' ssh-rsa ' + KEYS[0],
+            'al* ssh-rsa ' + KEYS[1],
+        )
+        self.write(self.paths[1],
+            'alpha ssh-rsa ' + KEYS[2],
+            'alps ssh-rsa ' + KEYS[3],
+        )
+        hosts = self.known_hosts()
+        self.assertEqual(hosts['alpha'], FPS[0])
+        self.assertEqual(hosts['alps'], FPS[1])
+
+    def test_missing_files_are_skipped(self):
+        self.write(self.paths[1], 'alpha ssh-rsa ' + KEYS[0])
+        self.assertEqual(self.known_hosts()['alpha'], FPS[0])
+
+    def test_cache_is_used_until_a_file_changes(self):
+        self.write(self.paths[0], 'alpha ssh-rsa ' + KEYS[0])
+        self.known_hosts()
+        self.assertTrue(os.path.exists(self.cache))
+        original = KnownHosts.__dict__['parse']
+        KnownHosts.parse = staticmethod(lambda paths: self.fail("reparsed"))
+        try:
+            self.assertEqual(self.known_hosts()['alpha'], FPS[0])
+        finally:
+            KnownHosts.parse = original
+        self.write(self.paths[0], 'alpha ssh-rsa ' + KEYS[1], '')
+        self.assertEqual(self.known_hosts()['alpha'], FPS[1])
+
+
+class PathTranslatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.translator = PathTranslator()
+        self.translator.mounts = [
+            ('/cygdrive/c/Users', 'D:\\Profiles'), ('/cygdrive/c', 'C:'),
+            ('', 'C:\\cygwin'),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_translates_via_the_longest_mount_point(self):
+        t = self.translator.from_mounts
+        self.assertEqual(t('/cygdrive/c/Users/me'), 'D:\\Profiles\\me')
+        self.assertEqual(t('/cygdrive/c/Windows'), 'C:\\Windows')
+        self.assertEqual(t('/cygdrive/c'), 'C:\\')
+        self.assertEqual(t('/usr/bin'), 'C:\\cygwin\\usr\\bin')
+
+    def test_declines_unsafe_paths(self):
+        t = self.translator.from_mounts
+        self.assertIsNone(t('/cygdrive/c/what?'))
+        link = os.path.join(self.dir, 'link')
+        os.symlink('/tmp', link)
+        self.assertIsNone(t(os.path.join(link, 'file')))
+
+    def test_reads_drive_mounts(self):
+        mounts = os.path.join(self.dir, 'mounts')
+        with open(mounts, 'w') as f:
+            f.write('C:/cygwin/bin /usr/bin ntfs binary 0 0\n'
+                    'C:/cygwin / ntfs binary 0 0\n'
+                    'D:/My\\040Files /data ntfs binary 0 0\n'
+                    'none /proc proc rw 0 0\n')
+        self.assertEqual(PathTranslator.read_mounts(mounts), [
+            ('/usr/bin', 'C:\\cygwin\\bin'), ('/data', 'D:\\My Files'),
+            ('', 'C:\\cygwin'),
+        ])
+        self.assertEqual(PathTranslator.read_mounts('/nonexistent'), [])
+
+
+# Stands in for plink: runs the command it's given after its -T option
+LOCAL = ['sh', '-c', 'eval exec "$2"', 'plink']
+
+class ChannelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.channel = Channel(LOCAL, 5)
+
+    def tearDown(self):
+        self.channel.close()
+        shutil.rmtree(self.dir)
+
+    def test_runs_commands_with_input(self):
+        self.assertEqual(self.channel.run('cat; echo oops >&2; exit 3', 'in'),
+                         (3, 'in', 'oops\n'))
+        self.assertEqual(self.channel.run('echo again', ''), (0, 'again\n', ''))
+
+    def test_transfers_files_in_chunks(self):
+        data = os.urandom(CHUNK * 2 + 100)
+        path = os.path.join(self.dir, 'file')
+        self.assertEqual(self.channel.put(path, StringIO(data)), (0, '', ''))
+        out = StringIO()
+        self.assertEqual(self.channel.fetch(path, out), (0, '', ''))
+        self.assertEqual(out.getvalue(), data)
+
+    def test_reports_transfer_errors_and_keeps_going(self):
+        missing = os.path.join(self.dir, 'no', 'such', 'file')
+        rc, out, err = self.channel.put(missing, StringIO('data'))
+        self.assertEqual(rc, 1)
+        self.assertIn('No such file', err)
+        rc, out, err = self.channel.fetch(missing, StringIO())
+        self.assertEqual(rc, 1)
+        self.assertEqual(self.channel.run('echo ok', ''), (0, 'ok\n', ''))
+
+    def test_slow_commands_send_heartbeats(self):
+        self.channel.timeout = 1.5
+        self.assertEqual(self.channel.run('sleep 2; echo done', ''),
+                         (0, 'done\n', ''))
+
+    def test_times_out_when_the_server_is_silent(self):
+        from ansible.errors import AnsibleConnectionFailed
+        self.channel.timeout = .2
+        os.kill(self.channel.proc.pid, signal.SIGSTOP)  # (close() kills it)
+        self.assertRaises(AnsibleConnectionFailed,
+                          self.channel.run, 'echo hi', '')
+        self.assertIsNotNone(self.channel.proc.poll())
+
+
+class Runner(object):
+    sudo, sudo_pass, sudo_exe = True, None, 'sudo'
+
+class Master(object):
+    def poll(self):
+        return None     # still running
+
+class Routed(plink.Connection):
+    """A plink connection that records which way its commands go"""
+
+    def __init__(self):
+        self.runner, self.host, self.routes = Runner(), 'h', []
+
+    def connect_master(self):
+        return Master(), '', False
+
+    def _via_channel(self, method, cmd, in_data):
+        self.routes.append('channel')
+        return 0, '', ''
+
+class PTY(object):
+    def exec_command(self, conn, *args):
+        conn.routes.append('pty')
+        return 0, '', '', ''
+
+class CommandRoutingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.conn, self.saved, plink.SSHBase = Routed(), plink.SSHBase, PTY()
+
+    def tearDown(self):
+        plink.SSHBase = self.saved
+
+    def route(self, sudoable=True, in_data=None, **kw):
+        self.conn.exec_command('cmd', None, 'root', sudoable,
+                               in_data=in_data, **kw)
+        return self.conn.routes.pop()
+
+    def test_plain_commands_use_the_channel(self):
+        self.assertEqual(self.route(sudoable=False), 'channel')
+        self.conn.runner.sudo = False
+        self.assertEqual(self.route(), 'channel')
+
+    def test_pipelined_sudo_uses_the_channel(self):
+        self.assertEqual(self.route(in_data='module'), 'channel')
+
+    def test_sudo_gets_a_pty_unless_pipelined_without_a_password(self):
+        self.assertEqual(self.route(), 'pty')   # e.g. pipelining=False
+        self.conn.runner.sudo_pass = 'secret'
+        self.assertEqual(self.route(in_data='module'), 'pty')
+
+    def test_su_gets_a_pty(self):
+        self.assertEqual(self.route(in_data='module', su=True, su_user='x'),
+                         'pty')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,329 @@
+"""Pool-mode tests, each run in a fresh interpreter (the mode is per-process)
+
+The scripts connect through a fake connection plugin, whose commands report
+the pool process they ran in and the operations done on their connection.
+"""
+
+import os, sys, glob, json, time, shutil, signal, tempfile, textwrap
+import unittest, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLUGIN = '''
+import os, json
+from ansible.errors import AnsibleError, AnsibleConnectionFailed
+from winsible import plan
+
+closed = []     # ids of this process' closed connections
+attempts = []   # hosts this process has tried to connect to
+
+class Connection(object):
+    has_pipelining = False
+    delegate = None
+
+    def __init__(self, runner, host, port, user=None, password=None,
+                 private_key_file=None, *args, **kw):
+        self.host, self.port, self.user = host, port, user
+        self.ops = []
+
+    def connect(self):
+        attempts.append(self.host)
+        if self.host == 'down':
+            raise AnsibleConnectionFailed('host is down')
+        self.ops.append('connect')
+        return self
+
+    def exec_command(self, cmd, tmp_path, *args, **kw):
+        if cmd == 'fail':
+            raise AnsibleError('failed on purpose')
+        self.ops.append('exec ' + cmd)
+        return 0, '', json.dumps(dict(
+            pid=os.getpid(), id=id(self), ops=self.ops, closed=closed,
+            attempts=attempts, plan=plan.current()
+        )), ''
+
+    def put_file(self, in_path, out_path):
+        with open(in_path) as f:
+            self.ops.append('put %s %s' % (f.read(), out_path))
+
+    def fetch_file(self, in_path, out_path):
+        with open(out_path, 'w') as f:
+            f.write('contents of ' + in_path)
+        self.ops.append('fetch ' + in_path)
+
+    def close(self):
+        closed.append(id(self))
+'''
+
+PRELUDE = '''
+import winsible, ansible.runner, json, os, sys
+ansible.runner.Runner   # (the mode's injected when the module's first used)
+from ansible.runner.connection import Connector
+from winsible import stats
+
+class Runner(object):
+    forks, timeout = 5, 10
+
+def connect(host):
+    return Connector(Runner()).connect(host, 22, 'user', None, 'fake', None)
+
+def run(conn, cmd):
+    return json.loads(conn.exec_command(cmd, None)[2])
+
+def ipc(host):
+    return stats.data.get('ipc', {}).get(host, [0])[0]
+
+def report(**results):
+    sys.stdout.write(json.dumps(results))
+'''
+
+
+class PoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        plugins = os.path.join(self.dir, 'plugins')
+        os.mkdir(plugins)
+        with open(os.path.join(plugins, 'fake.py'), 'w') as f:
+            f.write(PLUGIN)
+        self.env = dict(os.environ,
+            ANSIBLE_PROCESS_MODE='pool', ANSIBLE_CONNECTION_PLUGINS=plugins,
+            WINSIBLE_STATS=os.path.join(self.dir, 'stats.json'),
+            HOME=self.dir, PYTHONPATH=ROOT,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_script(self, script, **env):
+        """Run PRELUDE + `script`, returning what it report()s (on stdout)"""
+        proc = subprocess.Popen(
+            [sys.executable, '-c', PRELUDE + textwrap.dedent(script)],
+            env=dict(self.env, **env), cwd=self.dir,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        out, self.stderr = proc.communicate()
+        self.assertEqual(proc.returncode, 0, self.stderr)
+        return json.loads(out)
+
+
+class BatchingTests(PoolTestCase):
+
+    def test_batches_operations_on_one_pool_connection(self):
+        res = self.run_script('''
+            with open('module', 'w') as f:
+                f.write('source')
+            conn = connect('h1')
+            conn.put_file('module', '/tmp/module')
+            first = run(conn, 'one')
+            trips = ipc('h1')
+            attrs = conn.host, conn.port, conn.has_pipelining, conn.delegate
+            second = run(conn, 'two')
+            report(first=first, second=second, trips=trips, attrs=attrs,
+                   total=ipc('h1'), me=os.getpid())
+        ''')
+        self.assertEqual(res['trips'], 1)   # snapshot + connect + put + exec
+        self.assertEqual(res['total'], 2)   # attributes came with the first
+        self.assertEqual(res['attrs'], ['h1', 22, False, None])
+        self.assertEqual(res['first']['ops'],
+                         ['connect', 'put source /tmp/module', 'exec one'])
+        self.assertEqual(res['second']['id'], res['first']['id'])
+        self.assertNotEqual(res['first']['pid'], res['me'])
+
+    def test_close_releases_the_pool_connection(self):
+        res = self.run_script('''
+            conn = connect('h1')
+            first = run(conn, 'one')
+            conn.close()
+            report(first=first, later=run(connect('h1'), 'two'))
+        ''')
+        self.assertIn(res['first']['id'], res['later']['closed'])
+        self.assertNotEqual(res['later']['id'], res['first']['id'])
+
+    def test_closing_an_unused_connection_costs_nothing(self):
+        res = self.run_script('''
+            connect('h1').close()
+            report(trips=ipc('h1'))
+        ''')
+        self.assertEqual(res['trips'], 0)
+
+    def test_closing_after_a_failed_connect_does_not_reconnect(self):
+        res = self.run_script('''
+            from ansible.errors import AnsibleConnectionFailed
+            conn = connect('down')
+            try:
+                run(conn, 'one')
+            except AnsibleConnectionFailed, e:
+                error = str(e)
+            conn.close()
+            report(error=error, attempts=run(connect('h1'), 'two')['attempts'])
+        ''')
+        self.assertEqual(res['error'], 'host is down')
+        self.assertEqual(res['attempts'], ['down', 'h1'])
+
+    def test_fetches_other_attributes_on_demand(self):
+        res = self.run_script('''
+            conn = connect('h1')
+            run(conn, 'one')
+            report(ops=conn.ops, missing=hasattr(conn, 'missing'),
+                   default=getattr(conn, 'missing', 'default'))
+        ''')
+        self.assertEqual(res['ops'], ['connect', 'exec one'])
+        self.assertEqual(res['missing'], False)
+        self.assertEqual(res['default'], 'default')
+
+    def test_errors_reach_the_worker(self):
+        res = self.run_script('''
+            from ansible.errors import AnsibleError
+            try:
+                connect('h1').exec_command('fail', None)
+            except AnsibleError, e:
+                report(error=str(e))
+        ''')
+        self.assertEqual(res['error'], 'failed on purpose')
+
+    def test_fetches_to_the_workers_directory(self):
+        res = self.run_script('''
+            connect('h1').fetch_file('/remote/file', 'local')
+            report(data=open('local').read())
+        ''')
+        self.assertEqual(res['data'], 'contents of /remote/file')
+
+
+class ShardTests(PoolTestCase):
+
+    def test_hosts_stay_on_their_shard(self):
+        res = self.run_script('''
+            hosts = ['h%d' % i for i in range(12)]
+            report(
+                first=[run(connect(h), 'one')['pid'] for h in hosts],
+                again=[run(connect(h), 'two')['pid'] for h in hosts],
+            )
+        ''', ANSIBLE_POOL_SHARDS='3')
+        self.assertEqual(res['first'], res['again'])
+        self.assertEqual(len(set(res['first'])), 3)
+
+
+class ParallelExecTests(PoolTestCase):
+
+    def test_runs_each_host_once_in_forked_workers(self):
+        res = self.run_script('''
+            from multiprocessing import active_children
+            parallel_exec = ansible.runner.Runner.__dict__['_parallel_exec']
+
+            class Task(Runner):
+                forks = 3
+                def _executor(self, host, new_stdin):
+                    conn = connect(host)    # left open, for release()
+                    return dict(host=host, pid=os.getpid(),
+                                conn=run(conn, 'one')['id'],
+                                data='x' * (100000 if host == 'h0' else 10))
+
+            results = parallel_exec(Task(), ['h%d' % i for i in range(8)])
+            report(results=results, empty=parallel_exec(Task(), []),
+                   children=[p.pid for p in active_children()], me=os.getpid(),
+                   closed=run(connect('h9'), 'two')['closed'])
+        ''')
+        by_host = dict((r['host'], r) for r in res['results'])
+        self.assertEqual(len(res['results']), 8)
+        self.assertEqual(sorted(by_host), ['h%d' % i for i in range(8)])
+        self.assertEqual(len(by_host['h0']['data']), 100000)
+        pids = set(r['pid'] for r in res['results'])
+        self.assertNotIn(res['me'], pids)
+        self.assertTrue(len(pids) <= 3)
+        self.assertEqual(res['empty'], [])
+        self.assertFalse(pids & set(res['children']))  # all joined
+        for r in res['results']:    # released when their workers exited
+            self.assertIn(r['conn'], res['closed'])
+
+
+class OutputTests(PoolTestCase):
+
+    def test_writes_other_processes_output_before_exiting(self):
+        self.run_script('''
+            from ansible.callbacks import display
+            from multiprocessing import Process
+            def chatter():
+                for i in range(500):
+                    display('line %d' % i, stderr=True)
+            worker = Process(target=chatter)
+            worker.start()
+            worker.join()
+            report()
+        ''')
+        self.assertEqual(self.stderr.splitlines()[-1], 'line 499')
+
+
+class DaemonTests(PoolTestCase):
+
+    def setUp(self):
+        PoolTestCase.setUp(self)
+        self.env['ANSIBLE_POOL_DAEMON'] = '60'
+        self.daemons = set()
+
+    def tearDown(self):
+        for pid in self.daemons:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        PoolTestCase.tearDown(self)
+
+    def daemon_pid(self, script='', **env):
+        """Run `script` attached to the daemon, returning the daemon's pid"""
+        res = self.run_script(script + '''
+            report(pid=run(connect('h1'), 'one')['pid'], me=os.getpid())
+        ''', **env)
+        self.assertNotEqual(res['pid'], res['me'])
+        self.daemons.add(res['pid'])
+        return res['pid']
+
+    def sockets(self):
+        return glob.glob(os.path.join(self.dir, '.ansible/winsible/*.sock'))
+
+    def test_later_runs_reattach_to_the_daemon(self):
+        first = self.daemon_pid()
+        self.assertEqual(self.daemon_pid(), first)
+        self.assertEqual(len(self.sockets()), 1)
+
+    def test_replaces_a_killed_daemon_despite_its_socket(self):
+        first = self.daemon_pid()
+        os.kill(first, signal.SIGKILL)
+        time.sleep(.1)
+        self.assertEqual(len(self.sockets()), 1)    # stale
+        self.assertNotEqual(self.daemon_pid(), first)
+
+    def test_exits_when_idle_and_no_runs_are_attached(self):
+        self.daemon_pid('''
+            import time
+            time.sleep(2.5)     # attached, but idle for over pool_daemon secs
+        ''', ANSIBLE_POOL_DAEMON='1')   # (which then still answers)
+        deadline = time.time() + 10
+        while self.sockets() and time.time() < deadline:
+            time.sleep(.1)
+        self.assertEqual(self.sockets(), [])
+
+    def test_plans_for_every_attached_run(self):
+        child = PRELUDE + textwrap.dedent('''
+            from winsible import plan
+            plan.update(['b'], ['x'], 4, 3)
+            report(plan=run(connect('b'), 'one')['plan'])
+        ''')
+        res = self.run_script('''
+            import subprocess
+            from winsible import plan
+            plan.update(['a'], (), 3, 2)
+            both = json.loads(subprocess.check_output(
+                [sys.executable, '-c', os.environ['CHILD']]
+            ))['plan']
+            plan.update(['a'], ['a'], 3, 2)
+            after = run(connect('a'), 'two')
+            report(both=both, after=after['plan'], pid=after['pid'])
+        ''', CHILD=child)
+        self.daemons.add(res['pid'])
+        self.assertEqual(res['both'], [['a', 'b'], ['x'], 7, 5])
+        self.assertEqual(res['after'], [['a'], ['a'], 3, 2])   # b's run ended
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import unittest
+from winsible import stats
+
+
+class StatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = stats.enabled, stats.SAMPLES, stats.take()
+        stats.enabled = True
+
+    def tearDown(self):
+        stats.take()
+        stats.enabled, stats.SAMPLES, saved = self.saved
+        stats.merge(saved)
+
+    def test_exact_percentiles(self):
+        samples = [i / 1000.0 for i in range(100, 0, -1)]   # 1..100 ms
+        self.assertAlmostEqual(stats.exact(samples, .5), 50)
+        self.assertAlmostEqual(stats.exact(samples, .99), 99)
+        self.assertAlmostEqual(stats.exact(samples, 1), 100)
+        self.assertAlmostEqual(stats.exact([.25], .99), 250)
+        self.assertEqual(stats.exact([], .5), 0)
+
+    def test_histogram_percentiles_are_bucket_bounds(self):
+        for ms in (1, 3, 3, 100):
+            stats.record('task', 'h', ms / 1000.0)
+        count, total, top, hist, samples = stats.take()['task']['h']
+        self.assertEqual(stats.percentile(hist, count, .5), 4)
+        self.assertEqual(stats.percentile(hist, count, .99), 128)
+        self.assertEqual(samples, [])
+
+    def test_merging(self):
+        stats.record('task', 'a', .1)
+        stats.record('task', 'b', .3)
+        other = stats.take()
+        stats.record('task', 'a', .2)
+        stats.record('connect', 'a')
+        stats.merge(other)
+        data = stats.take()
+        self.assertEqual(data['task']['a'][0], 2)
+        self.assertAlmostEqual(data['task']['a'][1], .3)
+        self.assertEqual(data['task']['a'][2], .2)
+        self.assertEqual(data['connect']['a'][:2], [1, 0.0])
+        line = [l for l in stats.summary(data) if l.startswith('task')][0]
+        self.assertEqual(line.split()[4:6], ['256', '512'])
+
+    def test_samples_survive_merging(self):
+        stats.SAMPLES = True
+        stats.record('task', 'a', .1)
+        other = stats.take()
+        stats.record('task', 'a', .2)
+        stats.merge(other)
+        data = stats.take()
+        self.assertEqual(sorted(data['task']['a'][4]), [.1, .2])
+        line = [l for l in stats.summary(data) if l.startswith('task')][0]
+        self.assertEqual(line.split()[4:6], ['100', '200'])
+
+
+if __name__ == '__main__':
+    unittest.main()
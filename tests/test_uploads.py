@@ -0,0 +1,89 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import os, shutil, tempfile, unittest, subprocess
+from winsible import uploads
+
+
+class Connection(object):
+    """Runs "remote" commands locally, in a stand-in home directory"""
+
+    def __init__(self, home):
+        self.home, self.host, self.port, self.user = home, 'h', 22, 'u'
+        self.uploads = []   # remote paths uploaded to
+
+    def exec_command(self, cmd, tmp_path, *args, **kw):
+        proc = subprocess.Popen(
+            cmd, shell=True, cwd=self.home,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        out, err = proc.communicate()
+        return proc.returncode, '', out, err
+
+    def upload(self, in_path, out_path):
+        self.uploads.append(out_path)
+        shutil.copy(in_path, os.path.join(self.home, out_path))
+
+
+class UploadCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = uploads.DAYS, C.PROCESS_MODE, dict(uploads.caches)
+        uploads.DAYS, C.PROCESS_MODE = 1, 'threads'
+        uploads.caches.clear()
+        self.conn = Connection(self.dir)
+        self.source = os.path.join(self.dir, 'source')
+        with open(self.source, 'w') as f:
+            f.write('module source')
+
+    def tearDown(self):
+        uploads.DAYS, C.PROCESS_MODE, caches = self.saved
+        uploads.caches.clear()
+        uploads.caches.update(caches)
+        shutil.rmtree(self.dir)
+
+    def put(self, out_path):
+        uploads.put_file(self.conn, self.source, out_path, self.conn.upload)
+        with open(os.path.join(self.dir, out_path)) as f:
+            self.assertEqual(f.read(), 'module source')
+
+    def test_caches_files_uploaded_more_than_once(self):
+        for name in 'abc':
+            self.put(name)
+        key = uploads.digest(self.source)
+        self.assertEqual(self.conn.uploads[0], 'a')
+        self.assertTrue(self.conn.uploads[1].startswith(
+            uploads.CACHE_DIR + '/' + key + '.'
+        ))
+        self.assertEqual(len(self.conn.uploads), 2)     # c came from the cache
+
+    def test_reuses_files_cached_by_earlier_runs(self):
+        self.put('a')
+        self.put('b')
+        uploads.caches.clear()
+        self.put('c')
+        self.assertEqual(len(self.conn.uploads), 2)
+
+    def test_keeps_the_cache_private(self):
+        cache_dir = os.path.join(self.dir, uploads.CACHE_DIR)
+        os.makedirs(cache_dir, 0755)
+        self.put('a')
+        self.put('b')
+        key = uploads.digest(self.source)
+        mode = lambda path: os.stat(path).st_mode & 0777
+        self.assertEqual(mode(cache_dir), 0700)
+        self.assertEqual(mode(os.path.join(cache_dir, key)), 0600)
+
+    def test_uploads_directly_when_disabled(self):
+        uploads.DAYS = 0
+        for name in 'abc':
+            self.put(name)
+        self.assertEqual(self.conn.uploads, ['a', 'b', 'c'])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dir, uploads.CACHE_DIR)
+        ))
+
+
+if __name__ == '__main__':
+    unittest.main()
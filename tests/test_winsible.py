@@ -0,0 +1,147 @@
+import winsible, ansible.constants as C
+C.PROCESS_MODE = 'fork'  # the runner injection needs a concrete mode
+
+import time, unittest
+from threading import Lock
+from winsible import HashRing, Overlay
+
+
+class HashRingTests(unittest.TestCase):
+
+    keys = ['host%d.example.com' % i for i in range(2000)]
+
+    def test_is_deterministic(self):
+        ring, other = HashRing(range(4)), HashRing(range(4))
+        self.assertEqual([ring[k] for k in self.keys],
+                         [other[k] for k in self.keys])
+
+    def test_spreads_keys_across_shards(self):
+        ring = HashRing(range(4))
+        counts = [0] * 4
+        for key in self.keys:
+            counts[ring[key]] += 1
+        for count in counts:
+            self.assertTrue(250 < count < 750, counts)
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        before, after = HashRing(range(4)), HashRing(range(5))
+        moved = [k for k in self.keys if before[k] != after[k]]
+        self.assertTrue(all(after[k] == 4 for k in moved))
+        self.assertTrue(len(moved) < len(self.keys) / 3, len(moved))
+
+    def test_single_shard(self):
+        ring = HashRing(['only'])
+        self.assertEqual(set(ring[k] for k in self.keys), set(['only']))
+
+
+class OverlayTests(unittest.TestCase):
+
+    def test_overrides_without_changing_the_module(self):
+        overlay = Overlay(C, ANSIBLE_SSH_PIPELINING=True)
+        original = C.ANSIBLE_SSH_PIPELINING
+        self.assertIs(overlay.ANSIBLE_SSH_PIPELINING, True)
+        self.assertIs(C.ANSIBLE_SSH_PIPELINING, original)
+        self.assertEqual(overlay.DEFAULT_TIMEOUT, C.DEFAULT_TIMEOUT)
+
+
+class Batched(object):
+    """A connection whose class preconnects a whole batch at once"""
+    batches = []
+    def __init__(self):
+        self.closed = False
+    @classmethod
+    def preconnect_all(cls, conns):
+        cls.batches.append(conns)
+    def close(self):
+        self.closed = True
+
+class Single(object):
+    """A connection that can only be preconnected by itself"""
+    closed = preconnected = False
+    running, most = 0, 0
+    lock = Lock()
+    def preconnect(self):
+        with self.lock:
+            Single.running += 1
+            Single.most = max(Single.most, Single.running)
+        time.sleep(.05)
+        with self.lock:
+            Single.running -= 1
+        self.preconnected = True
+    def close(self):
+        self.closed = True
+
+class PreconnectTests(unittest.TestCase):
+
+    def test_preconnects_in_parallel_up_to_the_limit(self):
+        Single.most = 0
+        conns = [Single() for i in range(10)]
+        winsible.preconnect_all([lambda conn=conn: conn for conn in conns], 4)
+        self.assertTrue(all(c.preconnected and c.closed for c in conns))
+        self.assertEqual(Single.most, 4)
+
+    def test_batches_connections_that_support_it(self):
+        Batched.batches = []
+        conns = [Batched() for i in range(7)] + [Single() for i in range(3)]
+        winsible.preconnect_all([lambda conn=conn: conn for conn in conns], 4)
+        self.assertEqual(len(Batched.batches), 1)
+        self.assertEqual(set(Batched.batches[0]), set(conns[:7]))
+        self.assertTrue(all(conn.closed for conn in conns))
+        self.assertTrue(all(conn.preconnected for conn in conns[7:]))
+
+    def test_ignores_connection_errors(self):
+        def fail():
+            raise IOError("no route to host")
+        conn = Single()
+        winsible.preconnect_all([fail, lambda: conn], 2)
+        self.assertTrue(conn.preconnected and conn.closed)
+
+
+class Opened(object):
+    """A connection opened by the Loader below"""
+    has_pipelining = False
+    def connect(self):
+        return self
+
+class Loader(object):
+    """Stands in for ansible's connection_loader, recording what it opens"""
+    def get(self, transport, runner, host, port, **kw):
+        self.opened = transport, host, port, kw
+        self.conn = Opened()
+        return self.conn
+
+class Inventory(object):
+    def get_variables(self, host, vault_password=None):
+        return dict(ansible_ssh_port='2222', ansible_ssh_user='{{ who }}',
+                    who='admin')
+
+class Runner(object):
+    """Just the settings connect() reads"""
+    inventory, basedir, vault_pass = Inventory(), '.', None
+    remote_port, remote_user, remote_pass = 22, 'me', 'pw'
+    transport, private_key_file = 'fake', None
+
+class ConnectTests(unittest.TestCase):
+
+    def setUp(self):
+        from ansible import utils
+        self.plugins, self.loader = utils.plugins, Loader()
+        self.saved = self.plugins.connection_loader
+        self.plugins.connection_loader = self.loader
+
+    def tearDown(self):
+        self.plugins.connection_loader = self.saved
+
+    def test_connects_with_the_hosts_variables(self):
+        from ansible.runner.connection import Connector
+        runner = Runner()
+        runner.connector = Connector(runner)
+        conn = winsible.connect(runner, 'h1')
+        self.assertEqual(self.loader.opened, ('fake', 'h1', 2222, dict(
+            user='admin', password='pw', private_key_file=None
+        )))
+        self.assertIs(conn, self.loader.conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,18 @@
 """Set up processing model and inject transport modules"""
 
-import sys, pkg_resources
+import sys
 assert 'ansible' not in sys.modules, "winsible must be imported before ansible!"
 
 import ansible.constants as C
 from peak.util.imports import whenImported, lazyModule
+from winsible import stats, plan, facts, adaptive
 
 @whenImported('ansible.runner')
 def inject_processing_model(runner):
     from ansible.errors import AnsibleError
 
+    inject_pipelining(runner)   # before any mode replaces the Connector
+
     if C.PROCESS_MODE == 'gevent':
         if gevent is None:
             raise AnsibleError("'gevent' mode requires winsible.configure()")
@@ -17,6 +20,8 @@ def inject_processing_model(runner):
 
     elif C.PROCESS_MODE == 'pool':
         inject_pool_runner(runner)
+    elif C.PROCESS_MODE == 'threads':
+        inject_threads_runner(runner)
     elif C.PROCESS_MODE == 'smart':
         raise AnsibleError("'smart' mode requires winsible.configure()")
     elif C.PROCESS_MODE == 'fork':
@@ -24,11 +29,41 @@ def inject_processing_model(runner):
     else:
         raise AnsibleError('No such processing mode: %r' % C.PROCESS_MODE)
 
+    if C.CONNECTION_WARMUP and C.PROCESS_MODE != 'fork':
+        inject_warmup(runner)
+
+    if C.PROCESS_MODE != 'fork':
+        inject_plan(runner)
+
+    if facts.enabled:
+        inject_fact_cache(runner)
+
+    if stats.enabled:
+        @wrap(runner.Runner)
+        def _executor(self, host, new_stdin):
+            with stats.timer('task', host):
+                return _executor.original(self, host, new_stdin)
+
 @whenImported('ansible.utils.plugins')
 def inject_plugins(plugins):
     # Make our transport modules findable as if they were built-in
     plugins.connection_loader.add_directory(__path__[0])
 
+    # Tasks running in threads (or the pool's request handlers) can race to
+    # load a transport, and loading one twice re-runs it over its own module,
+    # replacing its connection cache mid-run
+    from threading import Lock
+    load_lock = Lock()
+
+    @wrap(plugins.connection_loader)
+    def get(name, *args, **kw):
+        with load_lock:
+            return get.original(name, *args, **kw)
+
+    if stats.enabled:
+        # Print a timing summary at the end of playbooks
+        plugins.callback_loader.add_directory(__path__[0] + '/callbacks')
+
     # Override default transport types; prioritize pooling transports if
     # we're in a mode where that can help
     plugins.connection_loader.aliases.update(
@@ -39,6 +74,27 @@ def inject_plugins(plugins):
     )
 
 
+def inject_pipelining(runner):
+    """Let each connection's `has_pipelining` decide whether to pipeline
+
+    Ansible only pipelines if both the connection's `has_pipelining` and the
+    global `pipelining` setting are true.  Winsible's transports default to
+    pipelining (see C.POOLED_PIPELINING), so the runner is shown the setting
+    as true, and other transports' `has_pipelining` gets the real one folded
+    in when they're connected.
+    """
+    runner.C = Overlay(C, ANSIBLE_SSH_PIPELINING=True)
+
+    @wrap(runner.connection.Connector)
+    def connect(self, *args, **kw):
+        conn = connect.original(self, *args, **kw)
+        if not getattr(conn, 'pipelining_configured', False):
+            conn.has_pipelining = (
+                conn.has_pipelining and C.ANSIBLE_SSH_PIPELINING
+            )
+        return conn
+
+
 def wrap(ob, name=None):
     """Replace ob.name w/wrapper, saving original as wrapper.original"""
 
@@ -62,9 +118,57 @@ def inject_gevent_runner(runner):
     @wrap(runner.Runner)
     def _parallel_exec(self, hosts):
         """Run hosts in a gevent pool"""
-        from gevent.pool import Pool
-        pool = Pool(self.forks)
-        return pool.map(lambda host: self._executor(host, sys.stdin), hosts)
+        control = adaptive.controller(self.forks)
+        if control is None:
+            from gevent.pool import Pool
+            pool = Pool(self.forks)
+            return pool.map(lambda host: self._executor(host, sys.stdin), hosts)
+
+        # Start each host when there's a free slot, as many as the controller
+        # allows (which may change every time one finishes)
+        import gevent, time
+        from gevent.event import Event
+        control.begin()
+        greenlets, running, finished = [], [0], Event()
+
+        def run(host):
+            start = time.time()
+            try:
+                return self._executor(host, sys.stdin)
+            finally:
+                running[0] -= 1
+                control.done(time.time() - start, len(greenlets) < len(hosts))
+                finished.set()
+
+        for host in hosts:
+            while running[0] >= control.limit:
+                finished.clear()
+                finished.wait()
+            running[0] += 1
+            greenlets.append(gevent.spawn(run, host))
+        gevent.joinall(greenlets)
+        return [greenlet.get() for greenlet in greenlets]
+
+
+def inject_threads_runner(runner):
+    """Patch the runner module to use a thread pool for tasks"""
+
+    # Use thread RLocks for flow control instead of lockfiles
+    from threading import RLock
+    replace_locks(RLock)
+
+    # And run tasks in a thread pool
+    @wrap(runner.Runner)
+    def _parallel_exec(self, hosts):
+        """Run hosts in a thread pool"""
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.forks)
+        try:
+            return pool.map(
+                lambda host: self._executor(host, sys.stdin), hosts, 1
+            )
+        finally:
+            pool.close()
 
 
 class Clone(object):
@@ -75,35 +179,156 @@ class Clone(object):
         self.__dict__.update(data)
 
 
+class Overlay(object):
+    """A module's attributes, with some of them overridden"""
+    def __init__(self, module, **overrides):
+        self.__dict__.update(overrides, _module=module)
+
+    def __getattr__(self, attr):
+        return getattr(self._module, attr)
+
+
+class HashRing(object):
+    """Consistent hashing of string keys to a sequence of shards"""
 
+    def __init__(self, shards, replicas=64):
+        from hashlib import md5
+        self.hash = lambda key: int(md5(key).hexdigest()[:8], 16)
+        self.ring = sorted(
+            (self.hash('%d:%d' % (i, r)), shard)
+            for i, shard in enumerate(shards) for r in range(replicas)
+        )
+        self.points = [point for point, shard in self.ring]
 
+    def __getitem__(self, key):
+        from bisect import bisect
+        return self.ring[bisect(self.points, self.hash(key)) % len(self.ring)][1]
 
 
 
 def inject_pool_runner(runner):
     """Patch the runner module to use a multiprocessing connection pool"""
 
-    import os
+    import os, time, multiprocessing
+    from ansible.errors import AnsibleError
+    from threading import Thread
 
     from multiprocessing.managers import SyncManager, BaseProxy
 
     class PoolManager(SyncManager):
         """Manager for a process that will handle all connections"""
 
-    pool = PoolManager()
+    if C.POOL_DAEMON:
+        # A single, persistent pool process, shared by every winsible run
+        shards = [PoolManager(*daemon_address())]
+    else:
+        # Connections are spread across C.POOL_SHARDS processes by host
+        shards = [PoolManager() for i in range(max(1, C.POOL_SHARDS))]
+    ring = HashRing(range(len(shards)))
 
     @wrap(runner.Runner)
     def _parallel_exec(self, hosts):
-        """Use our pool manager in place of the generic one"""
-
-        # When ansible asks for a Manager, give it the PoolManager instead
-        @wrap(runner.multiprocessing)
-        def Manager():
-            # Put back the regular manager first!
-            runner.multiprocessing.Manager = Manager.original
-            return pool
+        """Run hosts in forked workers that stream results back over pipes
+
+        Hosts are handed out via a shared counter, and each worker sends its
+        results down its own pipe, so neither goes through a manager process.
+        Workers run in numbered slots, and exit when their slot is past the
+        (shared) limit; if the limit goes up, more are started.
+        """
+        import select, signal, traceback
+
+        start_pool()    # before forking, so the workers share it
+        next_host = multiprocessing.Value('i', 0)
+        control = adaptive.controller(self.forks)
+        if control:
+            control.begin()
+        limit = multiprocessing.RawValue(
+            'i', control.limit if control else self.forks
+        )
 
-        return _parallel_exec.original(self, hosts)
+        def work(slot, results, new_stdin):
+            if runner.HAS_ATFORK:
+                runner.atfork()
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            while slot < limit.value:
+                with next_host.get_lock():
+                    index = next_host.value
+                    next_host.value += 1
+                if index >= len(hosts):
+                    break
+                try:
+                    start = time.time()
+                    result = self._executor(hosts[index], new_stdin)
+                    results.send((time.time() - start, result))
+                except:
+                    traceback.print_exc()
+            results.close()
+
+        try:
+            fileno = sys.stdin.fileno()
+        except ValueError:
+            fileno = None
+
+        poller = select.poll()  # unlike select(), not limited to 1024 fds
+        workers, pipes = [], {} # pipes: fd -> (reader, slot)
+
+        def spawn(slot):
+            new_stdin = None
+            if fileno is not None:
+                try:
+                    new_stdin = os.fdopen(os.dup(fileno))
+                except OSError:
+                    pass
+            reader, writer = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(
+                target=work, args=(slot, writer, new_stdin)
+            )
+            worker.start()
+            writer.close()  # so we get EOF when the worker exits
+            if new_stdin is not None:
+                new_stdin.close()
+            workers.append(worker)
+            pipes[reader.fileno()] = reader, slot
+            poller.register(reader.fileno(), select.POLLIN)
+
+        def fill():
+            """Start workers in free slots, unless they'd have nothing to do"""
+            used = set(slot for reader, slot in pipes.values())
+            for slot in range(limit.value):
+                if len(used) >= len(hosts) - next_host.value:
+                    break
+                if slot not in used:
+                    spawn(slot)
+                    used.add(slot)
+
+        results = []
+        try:
+            fill()
+            while pipes:
+                for fd, event in poller.poll():
+                    try:
+                        seconds, result = pipes[fd][0].recv()
+                    except EOFError:
+                        poller.unregister(fd)
+                        pipes.pop(fd)[0].close()
+                    else:
+                        results.append(result)
+                        if control:
+                            limit.value = control.done(
+                                seconds, next_host.value < len(hosts)
+                            )
+                    fill()
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+        # Close what workers didn't (e.g. if a task raised an exception)
+        pids = [worker.pid for worker in workers]
+        for shard in range(len(shards)):
+            service_for(shard)._callmethod('release', (pids,))
+        return results
 
     @wrap(runner.connection)
     class Connector(runner.connection.Connector):
@@ -112,14 +337,128 @@ def inject_pool_runner(runner):
         def connect(self, *args, **kw):
             runner_data = Clone(self.runner, [
                 'su', 'su_pass', 'sudo', 'sudo_pass', 'sudo_exe',
-                'private_key_file', 'module_name', 'timeout',
-                'process_lockfile', 'output_lockfile'
+                'private_key_file', 'module_name', 'timeout', 'forks'
             ])
-            return pool.Connector(runner_data).connect(*args, **kw)
+            return PooledConnection(runner_data, args, kw)
+
+    # Ansible deletes the temp files it uploads as soon as put_file() returns,
+    # so deferred uploads are hard-linked here until the pool has sent them
+    import tempfile, itertools, shutil
+    from multiprocessing.util import Finalize
+    SPOOL = tempfile.mkdtemp(prefix='winsible-')
+    Finalize(None, shutil.rmtree, (SPOOL, True), exitpriority=-1)
+    spool_ids = itertools.count()
+    connection_ids = itertools.count()
+
+    services = {}   # (pid, shard) -> proxy for a shard's ConnectionService
+
+    def service_for(shard):
+        """Return this process' proxy for `shard`'s ConnectionService"""
+        key = os.getpid(), shard    # don't use a parent's proxies
+        if key not in services:
+            start_pool()
+            services[key] = shards[shard].ConnectionService()
+        return services[key]
+
+    class PooledConnection(object):
+        """Worker-side connection that batches operations for the pool
+
+        Each batch is sent to the pool process as a single request, which
+        performs the batched operations in order, and returns the result of
+        the last one.  The first batch also connects (using the pool's cached
+        connections) and snapshots the connection's attributes; the pool
+        keeps that connection for later batches, until close().  Uploads are
+        deferred until the next command or download, so that a module's
+        put_file() and exec_command() take only one round trip.
+        """
+
+        SNAPSHOT = ['host', 'port', 'user', 'password', 'private_key_file',
+                    'has_pipelining', 'delegate']
+
+        def __init__(self, runner_data, args, kw):
+            self._target = runner_data, args, kw   # until the pool connects
+            self._id = os.getpid(), next(connection_ids)
+            self.host = str(args[0] if args else kw.get('host'))
+            self._shard = ring[self.host]
+            self._pending = []  # deferred (method, args, kwargs) operations
+            self._spooled = []  # files to remove when _pending is sent
+            self._sent = False  # has a batch been sent (so must we close)?
+
+        def _send(self, *ops):
+            """Send pending ops + `ops` to the pool, returning last result"""
+            ops = self._pending + list(ops)
+            # (closing needn't connect, e.g. if the first batch failed to)
+            snapshot = self._target and [op[0] for op in ops] != ['close']
+            if snapshot:
+                ops.insert(0, ('snapshot', (self.SNAPSHOT,), {}))
+            spooled, self._pending, self._spooled = self._spooled, [], []
+            self._sent = True
+            try:
+                with stats.timer('ipc', self.host):
+                    results = service_for(self._shard)._callmethod(
+                        'run', (self._id, self._target, ops)
+                    )
+            finally:
+                for path in spooled:
+                    if os.path.exists(path):
+                        os.unlink(path)
+            if snapshot:
+                self._target = None
+                for attr, value in results[0].items():
+                    self.__dict__.setdefault(attr, value)   # e.g. `delegate`
+            return results[-1]
 
+        def __getattr__(self, attr):
+            if attr.startswith('__'):
+                raise AttributeError(attr)
+            res = self._send(('getattr', (attr,), {}))  # AttributeError if none
+            setattr(self, attr, res)    # avoid repeated IPC
+            return res
 
+        def connect(self):
+            return self
 
+        def exec_command(self, *args, **kw):
+            return self._send(('exec_command', args, kw))
 
+        def put_file(self, in_path, out_path):
+            spooled = os.path.join(SPOOL, '%d-%d' % (os.getpid(), next(spool_ids)))
+            try:
+                os.link(in_path, spooled)
+            except (OSError, AttributeError):
+                in_path = os.path.abspath(in_path)  # send it right away
+                return self._send(('put_file', (in_path, out_path), {}))
+            self._spooled.append(spooled)
+            self._pending.append(('put_file', (spooled, out_path), {}))
+
+        def fetch_file(self, in_path, out_path):
+            out_path = os.path.abspath(out_path)    # the pool's cwd may differ
+            return self._send(('fetch_file', (in_path, out_path), {}))
+
+        def preconnect(self):
+            return self._send(('preconnect', (), {}))
+
+        @staticmethod
+        def preconnect_all(conns):
+            """Have each shard preconnect its share of `conns` in one request"""
+            by_shard = {}
+            for conn in conns:
+                if conn._target:
+                    by_shard.setdefault(conn._shard, []).append(conn._target)
+            threads = [
+                Thread(target=service_for(shard)._callmethod,
+                       args=('preconnect', (targets,)))
+                for shard, targets in by_shard.items()
+            ]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        def close(self):
+            if self._sent or self._pending:
+                self._send(('close', (), {}))
 
     # Files can't be passed via IPC, so we need our pre-fork stdin
     try:
@@ -130,61 +469,498 @@ def inject_pool_runner(runner):
     def ConnectorFactory(runner_data):
         """Create a connector in the pool, using a remoted runner object"""
         runner_data._new_stdin = sys.stdin = NEW_STDIN
+        # Locks can't be pickled, but the pool inherited the same ones
+        runner_data.process_lockfile = runner.PROCESS_LOCKFILE
+        runner_data.output_lockfile = runner.OUTPUT_LOCKFILE
         return Connector.original(runner_data)
 
-    class ConnectionProxy(BaseProxy):
-        """Proxy for talking to pooled connections"""
+    class ConnectionService(object):
+        """Runs batches of operations on pooled connections"""
 
-        _exposed_ = [
-            'connect', 'exec_command', 'put_file', 'fetch_file', 'close',
-            '__getattribute__'
-        ]
-    
-        def __getattr__(self, attr):
-            res = self._callmethod('__getattribute__', [attr])
-            setattr(self, attr, res)    # avoid repeated IPC
-            return res
-    
-        for meth in _exposed_:
-            locals()[meth] = (
-                lambda name: lambda s,*a,**kw: s._callmethod(name, a, kw)
-            )(meth)
-    
-        del __getattribute__
+        def __init__(self):
+            from threading import Lock
+            self.lock, self.active, self.last_used = Lock(), 0, time.time()
+            self.connections = {}   # (pid, n) -> connection, until closed
+            self.plans = {}         # runner pid -> its plan, while it runs
 
-    class Data(object):
-        """Pickle-able collection of attributes (used for IPC)"""
-        def __init__(self, data):
-            self.__dict__.update(data)
-    
-        @classmethod
-        def clone(cls, ob, attrs):
-            return cls((attr, getattr(ob, attr, None)) for attr in attrs)
+        def run(self, conn_id, target, ops):
+            """Run `ops` on `conn_id`'s connection, connecting to `target`
 
+            Returns a list of the operations' results.  The connection is
+            kept for the next batch with the same id, until a `close` op.
+            """
+            with self.lock:
+                self.active += 1
+                conn = self.connections.get(conn_id)
+            try:
+                if conn is None:
+                    if [op[0] for op in ops] == ['close']:
+                        return [None]   # its first batch failed to connect
+                    runner_data, args, kw = target
+                    conn = ConnectorFactory(runner_data).connect(*args, **kw)
+                    with self.lock:
+                        self.connections[conn_id] = conn
+                results = []
+                for name, a, k in ops:
+                    if name == 'snapshot':
+                        results.append(Clone(conn, *a).__dict__)
+                    elif name == 'getattr':
+                        results.append(getattr(conn, *a))
+                    elif name == 'close':
+                        with self.lock:
+                            self.connections.pop(conn_id, None)
+                        results.append(conn.close())
+                    else:
+                        results.append(getattr(conn, name)(*a, **k))
+                return results
+            except AnsibleError, e:
+                e.args = (e.msg,)   # so the worker can unpickle it
+                raise
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    self.last_used = time.time()
+
+        def preconnect(self, targets):
+            """Open (and cache) connections to `targets`, in parallel"""
+            def opener(runner_data, args, kw):
+                return lambda: ConnectorFactory(runner_data).connect(*args, **kw)
+            preconnect_all(
+                [opener(*target) for target in targets], targets[0][0].forks
+            )
+
+        def release(self, pids):
+            """Close any connections left open by the (exited) `pids`"""
+            with self.lock:
+                leftovers = [
+                    self.connections.pop(key) for key in list(self.connections)
+                    if key[0] in pids
+                ]
+            for conn in leftovers:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+        def idle(self):
+            """Seconds since the last request finished (0 if any are running)"""
+            with self.lock:
+                return 0 if self.active else time.time() - self.last_used
+
+        def stats(self):
+            return stats.take()
+
+        def plan(self, pid, *args):
+            """Update runner `pid`'s plan, and plan for all the live runners
+
+            (A daemon can serve several runs at once, so each run's hosts are
+            kept in the batch, and only dropped if no other run is using them.)
+            """
+            with self.lock:
+                self.plans[pid] = args
+                for other in list(self.plans):
+                    try:
+                        os.kill(other, 0)
+                    except OSError:
+                        del self.plans[other]   # it's exited
+                plans = self.plans.items()
+                batches = dict((other, set(p[0])) for other, p in plans)
+                dropped = set()
+                for other, p in plans:
+                    dropped.update(set(p[1]).difference(*[
+                        batch for o, batch in batches.items() if o != other
+                    ]))
+                plan.update(
+                    set().union(*batches.values()), dropped,
+                    sum(p[2] for o, p in plans), sum(p[3] for o, p in plans)
+                )
+
+        def load(self):
+            return adaptive.sample()
+
+    service = ConnectionService()
 
-    # Connections and Connectors both have a '.connect()' method
-    # that returns a Connection
-    connectable = dict(connect='Connection')
-
-    PoolManager.register(
-        # pool.Connection returns a ConnectionProxy
-        'Connection', None, ConnectionProxy, method_to_typeid = connectable
-    )
     PoolManager.register(
-        # pool.Connector returns a for a Connector
-        'Connector', ConnectorFactory, None, method_to_typeid = connectable
+        'ConnectionService', lambda: service, None,
+        exposed=['run', 'preconnect', 'release', 'stats', 'plan', 'load']
     )
 
+    if stats.enabled:
+        for shard in range(len(shards)):
+            stats.collectors.append(
+                lambda shard=shard: started and
+                    service_for(shard)._callmethod('stats') or {}
+            )
+
+    if adaptive.enabled:
+        for shard in range(len(shards)):
+            adaptive.collectors.append(
+                lambda shard=shard: service_for(shard)._callmethod('load')
+            )
+
     #from multiprocessing.util import log_to_stderr
     #log_to_stderr(5)
 
-    # Now that our types are registered, we can start the pool process
-    pool.start()
+    if C.POOL_DAEMON:
+        # (before our locks are replaced, since the daemon uses its own)
+        attach_daemon(shards[0], service, NEW_STDIN)
+
+    # Flow control uses semaphores (shared by the pool and workers via fork,
+    # instead of managed locks that cost an IPC round trip to acquire), and
+    # output from other processes is written by the main one
+    replace_locks(multiprocessing.RLock)
+    serialize_output()
+
+    # Now that our types are registered, we can start the pool process(es),
+    # but not until they're needed (e.g. not for --version or --syntax-check)
+    from threading import RLock
+    start_lock, started = RLock(), []
+
+    def start_pool():
+        with start_lock:
+            if started:
+                return
+            if not C.POOL_DAEMON:
+                for shard in shards:
+                    shard.start()
+            started.append(True)
+            # ...and tell them what the runner's doing
+            plan.listeners.append(forward_plan)
+            forward_plan()
+
+    def forward_plan():
+        for shard in range(len(shards)):
+            service_for(shard)._callmethod(
+                'plan', (os.getpid(),) + tuple(plan.current())
+            )
+
+    if C.POOL_DAEMON:
+        start_pool()    # already attached
+
+
+
+#### Pool Daemon
+
+def daemon_address():
+    """Return the pool daemon's (socket path, authkey) for these settings
+
+    Runs with different interpreters or ansible settings get different
+    daemons, since the daemon's transports are configured when it starts.
+    """
+    import os, hashlib
+    settings = sorted(
+        item for item in os.environ.items()
+        if item[0].startswith(('ANSIBLE_', 'WINSIBLE_'))
+    )
+    if C.p is not None:
+        settings += [
+            (section, sorted(C.p.items(section, raw=True)))
+            for section in sorted(C.p.sections())
+        ]
+    digest = hashlib.md5(repr((sys.executable, __file__, settings)))
+    base = os.path.expanduser('~/.ansible/winsible/pool-' + digest.hexdigest()[:16])
+
+    if not os.path.isdir(os.path.dirname(base)):
+        os.makedirs(os.path.dirname(base), 0700)
+    if not os.path.exists(base + '.key'):
+        tmp = '%s.%d' % (base, os.getpid())
+        with os.fdopen(os.open(tmp, os.O_WRONLY|os.O_CREAT, 0600), 'wb') as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmp, base + '.key')     # atomic, unlike rename, if we lose
+        except OSError:                     # a race with another run
+            pass
+        os.unlink(tmp)
+    with open(base + '.key', 'rb') as f:
+        return base + '.sock', f.read()
+
+def attach_daemon(manager, service, stdin):
+    """Connect `manager` to its daemon, starting one if needed
+
+    Clients hold a shared lock on the `.users` file for as long as they run,
+    so an idle daemon can only exit when no runs are attached to it.  The
+    daemon holds an exclusive lock on its `.pid` file for as long as it runs.
+    """
+    import os, time
+    from ansible.errors import AnsibleError
+    base = manager.address[:-len('.sock')]
+
+    users = os.open(base + '.users', os.O_RDWR|os.O_CREAT, 0600)
+    fcntl_module.flock(users, fcntl_module.LOCK_SH)  # held until we exit
+    with open(base + '.lock', 'w') as lock:
+        fcntl_module.flock(lock, fcntl_module.LOCK_EX)
+        pid = os.open(base + '.pid', os.O_RDONLY|os.O_CREAT, 0600)
+        try:
+            fcntl_module.flock(pid, fcntl_module.LOCK_SH|fcntl_module.LOCK_NB)
+        except IOError:
+            try:
+                return manager.connect()    # it's running
+            except EnvironmentError:
+                pass    # (or was: it's just exited)
+        finally:
+            os.close(pid)
+        # Not running, but if it was killed, it left its socket (which
+        # multiprocessing would keep trying to connect to for 20 seconds)
+        if os.path.exists(manager.address):
+            os.unlink(manager.address)
+        start_daemon(manager, service, stdin, [users, lock.fileno()])
+        deadline = time.time() + 10
+        while True:
+            try:
+                return manager.connect()
+            except EnvironmentError:
+                if time.time() > deadline:
+                    raise AnsibleError(
+                        "Couldn't start pool daemon; see %s.log" % base
+                    )
+                time.sleep(.05)
+
+def start_daemon(manager, service, stdin, fds):
+    """Fork a detached process to run `manager`'s server until it's idle"""
+    import os
+    from multiprocessing import Process
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()     # so it outlives our session, and ignores our ^C
+        Process(target=serve_daemon, args=(manager, service, stdin, fds)).start()
+    finally:
+        os._exit(0)     # don't wait for it, or run our parent's exit hooks
+
+def serve_daemon(manager, service, stdin, fds):
+    """Serve pooled connections until idle for C.POOL_DAEMON seconds"""
+    import os, time
+    from threading import Thread, RLock
+    base = manager.address[:-len('.sock')]
+
+    for fd in fds:
+        os.close(fd)    # don't keep our creator's locks
+    pid = os.open(base + '.pid', os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+    fcntl_module.flock(pid, fcntl_module.LOCK_EX)   # until we exit
+    os.write(pid, '%d\n' % os.getpid())
+    null = os.open(os.devnull, os.O_RDWR)
+    log = os.open(base + '.log', os.O_WRONLY|os.O_CREAT|os.O_APPEND, 0600)
+    for fd, target in (0, null), (1, log), (2, log):
+        os.dup2(target, fd)
+    if stdin is not None:
+        os.dup2(null, stdin.fileno())   # don't hold our creator's terminal
+
+    # Requests are handled in threads, which lockf() won't keep apart
+    replace_locks(RLock)
+
+    server = manager.get_server()
+    thread = Thread(target=server.serve_forever, name='winsible pool daemon')
+    thread.daemon = True
+    thread.start()
 
-    # ...and use its managed lock instances
-    replace_locks(pool.RLock)
-    
+    users = os.open(base + '.users', os.O_RDWR|os.O_CREAT, 0600)
+    while True:
+        time.sleep(max(1, C.POOL_DAEMON - service.idle()))
+        if service.idle() >= C.POOL_DAEMON:
+            try:
+                fcntl_module.flock(users, fcntl_module.LOCK_EX|fcntl_module.LOCK_NB)
+            except IOError:
+                continue    # a run is still attached
+            return  # (the socket's removed at exit, before the lock's freed)
+
+
+
+#### Connection Cache Planning
+
+def inject_plan(runner):
+    """Patch the runner to tell connection caches what hosts it's using"""
+
+    def address(self, host):
+        inject = self.inventory.get_variables(host, vault_password=self.vault_pass)
+        return str(inject.get('ansible_ssh_host', host))
 
+    def update(self, hosts, dropped=()):
+        plan.update(
+            [address(self, host) for host in hosts],
+            [address(self, host) for host in dropped],
+            len(self.inventory.get_group('all').get_hosts()), self.forks
+        )
+
+    @wrap(runner.Runner)
+    def run(self):
+        """Update the plan before a task, and with unreachable hosts after"""
+        if not self.run_hosts:
+            self.run_hosts = self.inventory.list_hosts(self.pattern)
+        update(self, self.run_hosts)
+        results = run.original(self)
+        if results.get('dark'):
+            update(self, self.run_hosts, results['dark'])
+        return results
+
+
+
+#### Connection Warm-up
+
+def inject_warmup(runner):
+    """Patch the runner to connect to all of a task's hosts up front"""
+
+    warmed = set()
+
+    @wrap(runner.Runner)
+    def run(self):
+        """Open connections to not-yet-seen hosts before running the task"""
+        if not self.run_hosts:
+            self.run_hosts = self.inventory.list_hosts(self.pattern)
+        hosts = [host for host in self.run_hosts if host not in warmed]
+        if hosts:
+            warmed.update(hosts)
+            warm_up(self, hosts)
+        return run.original(self)
+
+def warm_up(runner, hosts):
+    """Connect to `hosts` in parallel, using at most runner.forks threads"""
+    preconnect_all(
+        [lambda host=host: connect(runner, host) for host in hosts],
+        runner.forks
+    )
+
+def preconnect_all(openers, limit):
+    """Open (and cache) connections by calling `openers` from `limit` threads
+
+    Connections whose class has a preconnect_all() (e.g. plink's, which
+    starts all of its master processes together) are passed to it in one
+    call, once every connection is open; the rest are preconnect()ed (if
+    they can be) by the thread that opened them.
+    """
+    from threading import Thread, Lock
+    from Queue import Queue, Empty
+
+    queue, batched, lock = Queue(), {}, Lock()
+    for opener in openers:
+        queue.put(opener)
+
+    def worker():
+        while True:
+            try:
+                opener = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                conn = opener()
+            except Exception:
+                continue    # the host's first task will report the problem
+            if hasattr(type(conn), 'preconnect_all'):
+                with lock:
+                    batched.setdefault(type(conn), []).append(conn)
+                continue
+            try:
+                if hasattr(conn, 'preconnect'):
+                    conn.preconnect()
+            except Exception:
+                pass
+            finally:
+                conn.close()
+
+    workers = [
+        Thread(target=worker) for i in range(min(limit, len(openers)))
+    ]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for cls, conns in batched.items():
+        try:
+            cls.preconnect_all(conns)
+        except Exception:
+            pass
+        finally:
+            for conn in conns:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+def connect(runner, host):
+    """Return a connection to `host`, made the way the runner would"""
+    from ansible.utils.template import template
+    inject = runner.inventory.get_variables(host, vault_password=runner.vault_pass)
+
+    def var(name, default):
+        return template(runner.basedir, inject.get(name, default), inject)
+
+    port = var('ansible_ssh_port', runner.remote_port)
+    return runner.connector.connect(
+        var('ansible_ssh_host', host),
+        int(port) if port is not None else None,
+        var('ansible_ssh_user', runner.remote_user),
+        var('ansible_ssh_pass', runner.remote_pass),
+        var('ansible_connection', runner.transport),
+        var('ansible_ssh_private_key_file', runner.private_key_file)
+    )
+
+
+
+#### Fact Caching
+
+FINGERPRINT_KEY = '_winsible_fingerprint'
+
+def inject_fact_cache(runner):
+    """Patch the runner to skip gathering facts that are cached and current"""
+
+    def gathering(self):
+        return (
+            self.is_playbook and self.module_name == 'setup'
+            and not self.module_args and not self.complex_args
+        )
+
+    @wrap(runner.Runner)
+    def _executor(self, host, new_stdin):
+        """Return cached facts if `host` is unchanged, or tag the new ones"""
+        if not gathering(self):
+            return _executor.original(self, host, new_stdin)
+        try:
+            fingerprint = fingerprint_host(self, host)
+        except Exception:
+            fingerprint = None  # the setup task will report the problem
+        cached = facts.get(host, fingerprint)
+        if cached is not None:
+            result = dict(
+                ansible_facts=cached, changed=False, verbose_override=True
+            )
+            self.callbacks.on_ok(host, result)
+            return runner.ReturnData(host=host, comm_ok=True, result=result)
+        data = _executor.original(self, host, new_stdin)
+        if fingerprint and data.is_successful() and 'ansible_facts' in data.result:
+            data.result[FINGERPRINT_KEY] = fingerprint
+        return data
+
+    @wrap(runner.Runner)
+    def run(self):
+        """Load the cache before gathering facts, and save new ones after"""
+        if not gathering(self):
+            return run.original(self)
+        facts.load()    # before forking, so workers share the mapping
+        results = run.original(self)
+        for host, result in results.get('contacted', {}).items():
+            fingerprint = result.pop(FINGERPRINT_KEY, None)
+            if fingerprint:
+                facts.store(host, result['ansible_facts'], fingerprint)
+        facts.save()
+        return results
+
+def fingerprint_host(runner, host):
+    """Return a digest of `host`'s state (and how we log in), or None"""
+    from hashlib import md5
+    conn = connect(runner, host)
+    try:
+        rc, stdin, stdout, stderr = conn.exec_command(facts.FINGERPRINT, None)
+    finally:
+        conn.close()
+    if rc or not stdout.strip():
+        return None
+    return md5(repr((
+        stdout, conn.user, runner.sudo and runner.sudo_user,
+        runner.su and runner.su_user
+    ))).hexdigest()
 
 
 
@@ -203,6 +979,98 @@ def inject_pool_runner(runner):
 
 
 
+
+
+#### Output Serialization
+
+def serialize_output():
+    """Send display() output from forked processes to a main-process writer
+
+    Instead of contending for ansible's output lock, other processes pickle
+    their messages onto a pipe, from which a thread in the main process
+    writes them.  The main process' own output waits until everything sent
+    so far has been written, so nothing's printed out of order, and it's
+    written under the same lock as the writer's, so lines don't interleave.
+    (Other processes' `runner` arguments can't be pickled, but the writer
+    doesn't need their output locks, since it's the only one writing.)
+    Whatever's still queued when the main process exits is written first.
+    """
+    import os, itertools
+    from threading import Thread, Condition, RLock
+    from multiprocessing.queues import SimpleQueue
+    from multiprocessing.util import Finalize
+
+    queue = SimpleQueue()
+    main_pid = os.getpid()
+    written = Condition()
+    output = RLock()    # held while writing, by the writer or main thread
+    tokens = itertools.count(1)
+    state = dict(flushed=0)
+
+    def display(msg, color=None, stderr=False, screen_only=False,
+                log_only=False, runner=None):
+        if os.getpid() != main_pid:
+            return queue.put((msg, color, stderr, screen_only, log_only))
+        flush()
+        with output:
+            return display.original(
+                msg, color, stderr, screen_only, log_only, runner
+            )
+
+    def flush():
+        """Wait for output already sent by other processes to be written"""
+        with written:
+            token = next(tokens)
+        queue.put(token)
+        with written:
+            while state['flushed'] < token:
+                written.wait()
+
+    def writer():
+        while True:
+            item = queue.get()
+            if item is None:
+                return  # shutdown() is done with us
+            elif isinstance(item, tuple):
+                try:
+                    with output:
+                        display.original(*item)
+                except Exception:
+                    pass    # e.g. stdout closed; keep draining
+            else:
+                with written:
+                    state['flushed'] = max(state['flushed'], item)
+                    written.notify_all()
+
+    @whenImported('ansible.callbacks')
+    def patch_callbacks(callbacks):
+        display.original = callbacks.display
+
+        @whenImported('ansible.utils')
+        @whenImported('ansible.utils.display_functions')
+        @whenImported('ansible.callbacks')
+        def patch_display(module):
+            if getattr(module, 'display', None) is display.original:
+                module.display = display
+            return module
+
+        return callbacks
+
+    def shutdown():
+        """Write what other processes have sent, then stop the writer"""
+        if os.getpid() == main_pid:
+            flush()
+            queue.put(None)
+            thread.join()
+
+    thread = Thread(target=writer, name='winsible output')
+    thread.daemon = True
+    thread.start()
+    # After the pool shuts down (priority 0), in case it sent anything
+    Finalize(None, shutdown, exitpriority=-5)
+
+
+
 #### Lock Management
 
 # Ansible uses fcntl.lockf() for flow control, so we have to patch it  :-(
@@ -215,7 +1083,8 @@ def lockf(fd, operation, *args, **kw):
         if operation & fcntl.LOCK_UN:
             return fd.release()
         else:
-            return fd.acquire(not (operation & fcntl.LOCK_NB))    
+            with stats.timer('lock_wait'):
+                return fd.acquire(not (operation & fcntl.LOCK_NB))
     return lockf.original(fd, operation, *args, **kw)
 
 
@@ -256,10 +1125,30 @@ C.PROCESS_MODE = C.get_config(
     C.p, C.DEFAULTS, 'processing_mode', 'ANSIBLE_PROCESS_MODE', 'smart'
 )
 
+# Pooling transports can send modules over stdin, saving a round trip or
+# three per task, so they do unless pipelining is explicitly turned off
+C.POOLED_PIPELINING = C.get_config(
+    C.p, 'ssh_connection', 'pipelining', 'ANSIBLE_SSH_PIPELINING', True,
+    boolean=True
+)
+
+C.CONNECTION_WARMUP = C.get_config(
+    C.p, C.DEFAULTS, 'connection_warmup', 'ANSIBLE_CONNECTION_WARMUP', False,
+    boolean=True
+)
+
+C.POOL_SHARDS = C.get_config(
+    C.p, C.DEFAULTS, 'pool_shards', 'ANSIBLE_POOL_SHARDS', 1, integer=True
+)
+
+C.POOL_DAEMON = C.get_config(
+    C.p, C.DEFAULTS, 'pool_daemon', 'ANSIBLE_POOL_DAEMON', 0, integer=True
+)
+
 gevent = None
 
 def configure(is_playbook):
-    if not is_playbook:
+    if not is_playbook and not C.POOL_DAEMON:
         # no point in using 'smart' transport; always default to ssh since the
         # connections won't persist anyway
         C.DEFAULT_TRANSPORT = C.get_config(
@@ -268,12 +1157,11 @@ def configure(is_playbook):
 
     if C.PROCESS_MODE == 'smart':
         """Pick a processing model based on platform and gevent availability"""
-        if is_playbook:
-            C.PROCESS_MODE = 'gevent'
-            try:
-                pkg_resources.require('gevent>=1.0.1')
-            except pkg_resources.ResolutionError:                
-                C.PROCESS_MODE = 'pool'    
+        if C.POOL_DAEMON:
+            C.PROCESS_MODE = 'pool'     # connections persist in the daemon
+        elif is_playbook:
+            C.PROCESS_MODE = 'gevent' if have_gevent() else 'pool'
+
         else:
             C.PROCESS_MODE = 'fork'
     
@@ -282,6 +1170,14 @@ def configure(is_playbook):
         import gevent.monkey
         gevent.monkey.patch_all()
 
+def have_gevent(minimum=(1, 0, 1)):
+    """Is gevent `minimum` or better importable?  (w/out pkg_resources)"""
+    try:
+        import gevent
+    except ImportError:
+        return False
+    return tuple(getattr(gevent, 'version_info', (0,))[:3]) >= minimum
+
 
 
 
@@ -289,9 +1185,50 @@ def configure(is_playbook):
 
 def wrap_script(script_name, is_playbook):
     configure(is_playbook)
+    path = find_script(script_name)
     maindict = sys.modules['__main__'].__dict__ 
     maindict.clear(); maindict['__name__'] = '__main__'
-    return pkg_resources.require('ansible')[0].run_script(script_name, maindict)
+    if path is None:
+        import pkg_resources    # slow, since it scans every distribution
+        return pkg_resources.require('ansible')[0].run_script(script_name, maindict)
+    maindict['__file__'] = path
+    with open(path) as f:
+        code = compile(f.read(), path, 'exec')
+    exec code in maindict
+
+def find_script(script_name):
+    """Return the path of one of ansible's scripts, or None if not found
+
+    Looks in the metadata of the ansible distribution that would be imported
+    (an egg's scripts, or the file list pip recorded when installing it), and
+    then next to the Python interpreter.
+    """
+    import os, imp
+    from glob import glob
+    site = os.path.dirname(imp.find_module('ansible')[1])
+    candidates = [os.path.join(site, 'EGG-INFO', 'scripts', script_name)]
+    for meta in sorted(glob(os.path.join(site, 'ansible-*-info'))):
+        candidates.append(os.path.join(meta, 'scripts', script_name))
+        for listing in 'installed-files.txt', 'RECORD':
+            try:
+                with open(os.path.join(meta, listing)) as f:
+                    files = [line.split(',')[0].strip() for line in f]
+            except IOError:
+                continue
+            candidates.extend(
+                os.path.normpath(os.path.join(
+                    site if listing == 'RECORD' else meta, path
+                )) for path in files if os.path.basename(path) == script_name
+            )
+    candidates.append(os.path.join(os.path.dirname(sys.executable), script_name))
+
+    for path in candidates:
+        try:
+            with open(path) as f:
+                if 'python' in f.readline():
+                    return path
+        except IOError:
+            pass
 
 def winsible():             return wrap_script('ansible', False)
 def winsible_playbook():    return wrap_script('ansible-playbook', True)
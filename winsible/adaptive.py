@@ -0,0 +1,166 @@
+"""Adaptive concurrency: how many hosts the runner works on at once
+
+If the `adaptive_forks` setting (`ANSIBLE_ADAPTIVE_FORKS` in the environment)
+is a range like `4:64` (or just a maximum), the `gevent` and `pool` runners
+start at `forks` (within the range), and ask the run's Controller how many
+hosts to run at once each time a host's task finishes.  After each window of
+finished tasks, it compares their median latency to that task's earlier
+ones, and measures the CPU use of the busiest process (and of the machine as
+a whole) and the connection cache's hit rate, over the same interval.
+
+The limit drops by a quarter if any of those show the control node is
+overloaded, and rises by a quarter if none are close to it and hosts had to
+wait for a slot.  Connection caches count() their hits and their misses for
+hosts they had to evict, and other processes (e.g. the pool) can be polled
+via `collectors`.
+"""
+
+import os, time, ansible.constants as C
+from threading import Lock
+from multiprocessing import util
+
+RANGE = C.get_config(
+    C.p, C.DEFAULTS, 'adaptive_forks', 'ANSIBLE_ADAPTIVE_FORKS', ''
+)
+
+enabled = str(RANGE).strip() not in ('', '0')
+
+WINDOW = 8          # minimum tasks finished between adjustments
+CPU_HIGH = 0.85     # a process (or the machine) this busy is saturated...
+CPU_LOW = 0.6       # ...and one this busy has room for more
+LATENCY_HIGH = 1.5  # median latency vs. the task's earlier windows
+LATENCY_LOW = 1.15
+HIT_LOW = 0.9       # fraction of cache checkouts that reused a connection
+
+counts = dict(hits=0, misses=0)
+lock = Lock()
+collectors = [] # callables returning other processes' sample()s
+control = None  # this run's Controller, once created
+
+def count(event):
+    """Count a connection cache 'hits' or 'misses' event"""
+    with lock:
+        counts[event] += 1
+
+def sample():
+    """Return this process' CPU seconds, cache hits, and cache misses so far"""
+    user, system = os.times()[:2]
+    return user + system, counts['hits'], counts['misses']
+
+def machine():
+    """Return (total, idle) CPU time of the whole machine, if available"""
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(field) for field in f.readline().split()[1:]]
+    except (IOError, ValueError):
+        return None
+    return sum(fields), sum(fields[3:5])  # idle + iowait
+
+def bounds(spec):
+    """Parse `max` or `min:max` into a (min, max) pair"""
+    low, sep, high = str(spec).strip().rpartition(':')
+    low, high = int(low or 1), int(high)
+    if not 0 < low <= high:
+        raise ValueError(spec)
+    return low, high
+
+class Controller(object):
+    """Adjusts `limit` from task latency, CPU use, and cache hit rate"""
+
+    def __init__(self, low, high, start):
+        self.low, self.high = low, high
+        self.limit = max(low, min(high, start))
+        self.levels = [self.limit]  # limit after each adjustment
+        self.lock = Lock()
+        self.meters = {}    # source -> (time, cpu, hits, misses) at last look
+        self.begin()
+
+    def begin(self):
+        """Start a new task, whose latencies aren't comparable to the last's"""
+        with self.lock:
+            self.samples, self.baseline, self.backlog = [], None, False
+
+    def done(self, seconds, backlog):
+        """A task took `seconds`; `backlog` = hosts are waiting for a slot"""
+        with self.lock:
+            self.samples.append(seconds)
+            self.backlog = self.backlog or backlog
+            if len(self.samples) >= max(WINDOW, self.limit):
+                self.adjust()
+        return self.limit
+
+    def adjust(self):
+        """Move the limit based on the window just finished (w/lock)"""
+        latency = sorted(self.samples)[len(self.samples) // 2]
+        if self.baseline is None:
+            self.baseline, ratio = latency, 1.0
+        else:
+            ratio = latency / (self.baseline or 1e-6)
+            self.baseline = .75 * self.baseline + .25 * latency
+        cpu, hit_rate = self.measure()
+
+        limit, step = self.limit, max(1, self.limit // 4)
+        if cpu > CPU_HIGH or hit_rate < HIT_LOW or ratio > LATENCY_HIGH:
+            limit = max(self.low, limit - step)
+        elif self.backlog and cpu < CPU_LOW and ratio < LATENCY_LOW:
+            limit = min(self.high, limit + step)
+        if limit != self.limit:
+            from ansible.callbacks import vvv
+            vvv("adaptive concurrency: %d -> %d (cpu %d%%, cache hits %d%%,"
+                " latency x%.2f)" % (self.limit, limit, cpu * 100,
+                hit_rate * 100, ratio))
+            self.limit = limit
+            self.levels.append(limit)
+        self.samples, self.backlog = [], False
+
+    def measure(self):
+        """Return peak CPU use and the cache hit rate since the last call"""
+        now, busiest, hits, misses = time.time(), 0.0, 0, 0
+        sources = [('local', sample)] + list(enumerate(collectors))
+        for key, source in sources:
+            try:
+                cpu, h, m = source()
+            except Exception:
+                continue    # e.g. the pool has already shut down
+            if key in self.meters:
+                then, last_cpu, last_h, last_m = self.meters[key]
+                busiest = max(busiest, (cpu - last_cpu) / max(now - then, .01))
+                hits, misses = hits + max(0, h - last_h), misses + max(0, m - last_m)
+            self.meters[key] = now, cpu, h, m
+
+        total = machine()
+        if total and 'machine' in self.meters:
+            last_total, last_idle = self.meters['machine']
+            if total[0] > last_total:
+                busiest = max(busiest, 1 - float(total[1] - last_idle) /
+                                           (total[0] - last_total))
+        self.meters['machine'] = total
+
+        if hits + misses < WINDOW:
+            return busiest, 1.0     # too few checkouts to judge
+        return busiest, hits / float(hits + misses)
+
+def controller(forks):
+    """Return the run's Controller (starting at `forks`), or None if disabled"""
+    global control
+    if enabled and control is None:
+        try:
+            low, high = bounds(RANGE)
+        except ValueError:
+            from ansible.errors import AnsibleError
+            raise AnsibleError(
+                "adaptive_forks must be a maximum or a min:max range, not %r"
+                % (RANGE,)
+            )
+        control = Controller(low, high, forks)
+        control.measure()   # start the meters
+        util.Finalize(None, report, exitpriority=5)
+    return control
+
+def report():
+    """Display the concurrency level the run ended with"""
+    from ansible.callbacks import display
+    levels = control.levels
+    display("adaptive concurrency: settled at %d (ranged %d-%d over %d"
+            " adjustments; bounds %d-%d)" % (control.limit, min(levels),
+            max(levels), len(levels) - 1, control.low, control.high))
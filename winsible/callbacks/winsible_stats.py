@@ -0,0 +1,19 @@
+"""Print winsible's connection and task timings at the end of a playbook"""
+
+from ansible.callbacks import display
+from multiprocessing import util
+from winsible import stats
+
+class CallbackModule(object):
+
+    def playbook_on_stats(self, playbook_stats):
+        # ansible-playbook calls this between the PLAY RECAP banner and its
+        # per-host lines, so gather the timings now, but print them at exit
+        util.Finalize(None, report, (stats.summary(),), exitpriority=5)
+
+def report(lines):
+    """Display the timings table gathered by playbook_on_stats()"""
+    display("WINSIBLE TIMINGS " + "*" * 63)
+    for line in lines:
+        display(line)
+    display("")
@@ -0,0 +1,125 @@
+"""On-disk cache of gathered facts, validated by a remote fingerprint
+
+If the `fact_cache_ttl` setting (`ANSIBLE_FACT_CACHE_TTL` in the environment)
+is a number of seconds, the facts gathered for each host are saved in a single
+cache file, along with a fingerprint of the host's state.  Within the TTL,
+later runs only need to fetch the fingerprint, and skip gathering facts from
+hosts where it still matches.
+
+The file is an index of host -> (offset, size, time saved, fingerprint),
+followed by the zlib-compressed JSON facts of each host.  It's read through a
+memory map, so processes only decompress the records they actually use.
+"""
+
+import os, json, zlib, mmap, time, fcntl, struct, marshal, tempfile
+import ansible.constants as C
+
+TTL = C.get_config(
+    C.p, C.DEFAULTS, 'fact_cache_ttl', 'ANSIBLE_FACT_CACHE_TTL', 0, integer=True
+)
+
+PATH = os.path.expanduser(C.get_config(
+    C.p, C.DEFAULTS, 'fact_cache_file', 'ANSIBLE_FACT_CACHE_FILE',
+    '~/.ansible/winsible_facts.cache'
+))
+
+enabled = TTL > 0
+
+# Outputs the host's boot id and the modification times of its package
+# databases, which change when it reboots or packages are (un)installed.
+# (rpm's are files, since rpm updates them in place, leaving the directory's
+# modification time alone.)
+FINGERPRINT = (
+    "cat /proc/sys/kernel/random/boot_id 2>/dev/null || "
+    "sysctl -n kern.boottime 2>/dev/null; "
+    "for f in /var/lib/dpkg/status /var/lib/rpm/Packages "
+    "/var/lib/rpm/rpmdb.sqlite /var/lib/pacman/local "
+    "/var/lib/apk/db/installed /var/db/pkg /etc/setup/installed.db; do "
+    "[ -e $f ] && { stat -c %Y $f 2>/dev/null || stat -f %m $f; }; done; true"
+)
+
+HEADER = struct.Struct('!4sI')  # magic, index size
+MAGIC = 'WFC1'
+
+index = None    # host -> (offset, size, saved, fingerprint)
+data = ''       # memory map of the cache file
+base = 0        # where the records start in `data`
+updates = {}    # host -> (facts, fingerprint, saved), for save()
+
+def load():
+    """(Re)read the cache file's index, and map the rest"""
+    global index, data, base
+    if isinstance(data, mmap.mmap):
+        data.close()    # unmap the old file, if any
+    index, data, base = {}, '', 0
+    try:
+        with open(PATH, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return  # missing or empty
+    try:
+        magic, size = HEADER.unpack_from(mapped)
+        if magic == MAGIC:
+            index = marshal.loads(mapped[HEADER.size:HEADER.size + size])
+            data, base = mapped, HEADER.size + size
+    except (struct.error, ValueError, EOFError, TypeError):
+        index = {}  # corrupt; it'll be replaced by the next save()
+    if data is not mapped:
+        mapped.close()
+
+def get(host, fingerprint):
+    """Return `host`'s cached facts, if unexpired and `fingerprint` matches"""
+    if index is None:
+        load()
+    entry = index.get(host)
+    if entry is None or not fingerprint:
+        return None
+    offset, size, saved, cached_fingerprint = entry
+    if cached_fingerprint != fingerprint or saved + TTL < time.time():
+        return None
+    try:
+        return json.loads(zlib.decompress(data[base+offset:base+offset+size]))
+    except (zlib.error, ValueError):
+        return None
+
+def store(host, facts, fingerprint):
+    """Remember `host`'s freshly gathered facts, for save()"""
+    updates[host] = facts, fingerprint, time.time()
+
+def save():
+    """Merge stored facts into the cache file, replacing it atomically"""
+    if not updates:
+        return
+    directory = os.path.dirname(PATH)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(PATH + '.lock', 'w') as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            load()  # pick up other runs' changes
+            records, new_index, offset, now = [], {}, 0, time.time()
+            for host, (start, size, saved, fingerprint) in index.items():
+                if host not in updates and saved + TTL >= now:
+                    records.append(data[base+start:base+start+size])
+                    new_index[host] = offset, size, saved, fingerprint
+                    offset += size
+            for host, (facts, fingerprint, saved) in updates.items():
+                record = zlib.compress(json.dumps(facts, separators=(',', ':')))
+                records.append(record)
+                new_index[host] = offset, len(record), saved, fingerprint
+                offset += len(record)
+            header = marshal.dumps(new_index)
+
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, len(header)))
+                f.write(header)
+                for record in records:
+                    f.write(record)
+            if isinstance(data, mmap.mmap):
+                data.close()    # Windows won't replace a mapped file
+            os.rename(tmp, PATH)
+            updates.clear()
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+    load()
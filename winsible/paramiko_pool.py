@@ -1,60 +1,639 @@
 from ansible.runner.connection_plugins.paramiko_ssh import Connection as Base
-from cachetools import TTLCache
+from ansible.runner.connection_plugins.paramiko_ssh import MyAddPolicy
+from collections import OrderedDict
+from threading import RLock, Thread, Condition
+from multiprocessing import util
+import os, mmap, time, fcntl, paramiko, resource, tempfile, traceback
+import ansible.constants as C
+from winsible import stats, plan, uploads, adaptive
 from ansible.constants import get_config, p as ansible_cfg
+from ansible.callbacks import vvv
+from ansible import errors
 
-CACHE_SIZE = get_config(ansible_cfg, 'paramiko_connection', 'max_connections',
-    'ANSIBLE_PARAMIKO_MAX_CONNECTIONS', 50, integer=True
-)
+CACHE_SIZE = str(get_config(ansible_cfg, 'paramiko_connection',
+    'max_connections', 'ANSIBLE_PARAMIKO_MAX_CONNECTIONS', 'auto'
+)).lower()
+CACHE_SIZE = CACHE_SIZE if CACHE_SIZE == 'auto' else int(CACHE_SIZE)
 
 TTL = get_config(ansible_cfg, 'paramiko_connection', 'max_ttl',
     'ANSIBLE_PARAMIKO_MAX_TTL', 60, integer=True
 )
 
-class Uncloseable(object):
-    """Proxy that keeps ansible from closing a connection prematurely"""
+MAX_CHANNELS = get_config(ansible_cfg, 'paramiko_connection', 'max_channels',
+    'ANSIBLE_PARAMIKO_MAX_CHANNELS', 10, integer=True
+)
 
-    def __init__(self, ssh):
-        self.__ssh = ssh
+MAX_TRANSPORTS = get_config(ansible_cfg, 'paramiko_connection',
+    'max_host_transports', 'ANSIBLE_PARAMIKO_MAX_HOST_TRANSPORTS', 0,
+    integer=True
+)
 
-    def __getattr__(self, attr):
-        return getattr(self.__ssh, attr)
+TRANSFER_CHUNK = 1 << 20     # bytes per read/write when transferring files
 
-    def close(self): pass
+KEEPALIVE = get_config(ansible_cfg, 'paramiko_connection', 'keepalive',
+    'ANSIBLE_PARAMIKO_KEEPALIVE', 0, integer=True
+)
 
-class ConnectionCache(TTLCache):
-    """LRU/TTL cache for paramiko connections"""
+KEEPALIVE_TTL = get_config(ansible_cfg, 'paramiko_connection',
+    'keepalive_ttl', 'ANSIBLE_PARAMIKO_KEEPALIVE_TTL', 600, integer=True
+)
+
+PROBE_AFTER = 10    # seconds a client can sit unused before it's probed
+PROBE_TIMEOUT = 5   # seconds to wait for the server to answer a probe
+
+def is_alive(client, probe=True):
+    """Is `client` still connected?  (If `probe`, ask the server to check)
+
+    Merely sending something only proves the local socket buffer had room,
+    so a probe is a keepalive request that the server has to answer within
+    PROBE_TIMEOUT seconds.  (If it doesn't, the client is closed.)
+    """
+    transport = client.get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    if probe:
+        request = Thread(target=keepalive, args=(transport,))
+        request.daemon = True
+        request.start()
+        request.join(PROBE_TIMEOUT)
+        if request.is_alive():
+            transport.close()   # no reply; this also ends the request
+            return False
+    return transport.is_active()
+
+def keepalive(transport):
+    """Send a keepalive request, returning once the server answers"""
+    try:
+        transport.global_request('keepalive@openssh.com', wait=True)
+    except Exception:
+        pass    # the transport is closed, so is_alive() will say so
+
+class HostPool(object):
+    """The paramiko clients open to one (host, port, user), w/channel counts"""
+
+    def __init__(self):
+        self.clients = {}   # client -> number of channels in use or idle
+        self.sftps = {}     # client -> idle SFTP sessions opened on it
+        self.touched = {}   # client -> when it was last used or probed
+        self.pending = 0    # number of clients currently being connected
+        self.waiting = 0    # number of checkouts waiting for a channel
+        self.last_used = 0  # when the cache last handed out or got it back
+        self.kept_alive = 0 # when a keepalive sweep last found it alive
+        self.lock = RLock()
+        self.ready = Condition(self.lock)   # a channel or client freed up
+
+    def checkout(self, conn):
+        """Reserve a channel on the least-used client, opening one if needed
+
+        Instead of opening another client, this waits for one that's being
+        opened (if it'll have a channel to spare), or for a channel to free
+        up (if the host already has `max_host_transports` clients).  After
+        the connection timeout, it shares the least-used client regardless.
+        Idle SFTP sessions count as channels, but are closed to make room.
+        """
+        deadline = time.time() + conn.runner.timeout
+        with self.lock:
+            while True:
+                client = self.least_used()
+                if client is not None and self.clients[client] >= MAX_CHANNELS:
+                    self.close_idle_sftp(client)
+                timed_out = time.time() >= deadline
+                if client is not None and (
+                    self.clients[client] < MAX_CHANNELS or timed_out
+                ):
+                    self.clients[client] += 1
+                    self.touched[client] = time.time()
+                    stats.record('cache_hit', conn.host)
+                    return client
+                capped = MAX_TRANSPORTS and (
+                    len(self.clients) + self.pending >= MAX_TRANSPORTS
+                )
+                coming = self.pending * (MAX_CHANNELS - 1) > self.waiting
+                if timed_out or not (capped or coming):
+                    break
+                self.waiting += 1
+                try:
+                    self.ready.wait(deadline - time.time())
+                finally:
+                    self.waiting -= 1
+            self.pending += 1   # connect without blocking other checkouts
+        stats.record('cache_miss', conn.host)
+        try:
+            with stats.timer('handshake', conn.host):
+                client = conn._connect_uncached()
+        except:
+            with self.lock:
+                self.pending -= 1
+                self.ready.notify_all() # let a waiter try connecting instead
+            raise
+        with self.lock:
+            self.pending -= 1
+            self.clients[client] = 1
+            self.touched[client] = time.time()
+            self.ready.notify_all()
+        return client
+
+    def checkin(self, client):
+        """Release a channel reserved by checkout()"""
+        with self.lock:
+            if self.clients.get(client):
+                self.clients[client] -= 1
+                self.touched[client] = time.time()
+                self.ready.notify()
+
+    def checkout_sftp(self, client):
+        """Return an idle SFTP session on `client`, or open a new one
+
+        The session counts as one of the client's channels until it's closed,
+        whether it's in use or idle.
+        """
+        with self.lock:
+            idle = self.sftps.get(client, [])
+            while idle:
+                sftp = idle.pop()
+                if not sftp.sock.closed:
+                    return sftp
+                self.checkin(client)    # (it closed while idle)
+            if client in self.clients:
+                self.clients[client] += 1
+        try:
+            return client.open_sftp()
+        except:
+            self.checkin(client)
+            raise
+
+    def checkin_sftp(self, client, sftp):
+        """Save an SFTP session for reuse, if it and its client are usable"""
+        with self.lock:
+            if client in self.clients and not sftp.sock.closed:
+                self.sftps.setdefault(client, []).append(sftp)
+                return
+            self.checkin(client)
+        sftp.close()
+
+    def close_idle_sftp(self, client):
+        """Close one of `client`'s idle SFTP sessions, freeing its channel"""
+        with self.lock:
+            idle = self.sftps.get(client)
+            if not idle:
+                return
+            sftp = idle.pop(0)
+            self.checkin(client)
+        sftp.close()
+
+    def least_used(self):
+        """Return the live client with the fewest channels, or None (w/lock)
+
+        Clients that have been unused for PROBE_AFTER seconds are probed,
+        with the lock released while waiting for the server's reply.
+        """
+        while self.clients:
+            client = min(self.clients, key=self.clients.get)
+            if time.time() - self.touched.get(client, 0) < PROBE_AFTER:
+                alive = is_alive(client, probe=False)
+            else:
+                self.touched[client] = time.time()  # so no one else probes it
+                self.lock.release()
+                try:
+                    alive = is_alive(client)
+                finally:
+                    self.lock.acquire()
+                if alive and client not in self.clients:
+                    continue    # discarded while we waited
+            if alive:
+                return client
+            self.discard(client)    # dead: the caller will reconnect instead
+
+    def discard(self, client):
+        """Forget and close a client (e.g. because it disconnected)"""
+        with self.lock:
+            self.clients.pop(client, None)
+            self.touched.pop(client, None)
+            sftps = self.sftps.pop(client, [])
+            self.ready.notify_all() # room for another client, if capped
+        for sftp in sftps:
+            sftp.close()
+        client.close()
 
-    def get(self, conn):
-        """Retrieve or create a connection"""
+    def close(self):
+        """Close all the clients (e.g. because the cache evicted this pool)"""
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.discard(client)
+
+    def expires(self, ttl):
+        """When the pool expires: `ttl` secs after its last use, or (if a
+        keepalive sweep has found it alive since) KEEPALIVE_TTL secs after"""
+        if self.kept_alive > self.last_used:
+            ttl = max(ttl, KEEPALIVE_TTL)
+        return self.last_used + ttl
+
+    def sweep(self, interval):
+        """Probe clients unused for `interval` secs, discarding dead ones
+
+        Returns true if any clients remain.  (The probes don't count as use;
+        see expires() for how long they can keep the pool around.)
+        """
+        now = time.time()
+        with self.lock:
+            idle = [
+                client for client, channels in self.clients.items()
+                if channels == len(self.sftps.get(client, ()))
+                and now - self.touched.get(client, 0) >= interval
+            ]
+            for client in idle:
+                self.touched[client] = now  # so checkouts don't probe it too
+        for client in idle:
+            if not is_alive(client):
+                self.discard(client)
+        with self.lock:
+            return bool(self.clients or self.pending)
+
+def auto_size(forks, host_count):
+    """Room for every host (or 2x forks), within half the process' fd limit"""
+    if not host_count:
+        return 50   # no plan yet (e.g. `fork` mode); use the old default
+    try:
+        fds = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (AttributeError, ValueError):
+        fds = resource.RLIM_INFINITY
+    size = max(host_count, 2 * forks)
+    if fds != resource.RLIM_INFINITY and fds > 0:
+        size = min(size, fds // 2)  # each host needs at least one socket
+    return max(size, forks, 1)
+
+class ConnectionCache(object):
+    """LRU/TTL cache of per-host pools of paramiko connections
+
+    When the cache is over its size, hosts outside the runner's current batch
+    (see winsible.plan) are evicted before the hosts in it, least recently
+    used first.  Pools that are in use are never evicted or expired, and the
+    connections of those that are get closed right away.
+    """
+
+    sweeper = None
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.pools = OrderedDict()  # key -> HostPool, least recently used 1st
+        self.users = {}             # HostPool -> number of checkouts
+        self.evicted = set()        # keys evicted for being over capacity
+        self.lock = RLock()
+
+    def capacity(self):
+        """The number of hosts to keep connections to"""
+        if self.maxsize == 'auto':
+            return auto_size(plan.forks, plan.host_count)
+        return self.maxsize
+
+    def checkout(self, conn):
+        """Reserve a client for `conn`, returning (pool, client)"""
         key = (conn.host, conn.port, conn.user)
-        ssh = TTLCache.get(self, key) or Uncloseable(conn._connect_uncached())
-        self[key] = ssh     # Mark as recently used
-        return ssh
+        if KEEPALIVE and self.sweeper is None:
+            self.start_sweeper(KEEPALIVE)
+        with self.lock:
+            pool = self.pools.pop(key, None)
+            if pool is not None:
+                adaptive.count('hits')
+            elif key in self.evicted:
+                self.evicted.discard(key)
+                adaptive.count('misses')    # reconnecting after an eviction
+            pool = pool or HostPool()
+            self.pools[key] = pool  # Mark as recently used
+            pool.last_used = time.time()
+            self.users[pool] = self.users.get(pool, 0) + 1
+            victims = self.victims()
+        self.close(victims)
+        try:
+            return pool, pool.checkout(conn)
+        except:
+            self.release(key, pool)
+            raise
+
+    def checkin(self, conn, pool, client):
+        """Release a client reserved by checkout(), marking it recently used"""
+        pool.checkin(client)
+        self.release((conn.host, conn.port, conn.user), pool)
+
+    def release(self, key, pool):
+        """Drop a checkout's hold on `pool`, marking it recently used"""
+        with self.lock:
+            self.users[pool] -= 1
+            if not self.users[pool]:
+                del self.users[pool]
+            if self.pools.get(key) is pool:
+                del self.pools[key]
+                self.pools[key] = pool
+                pool.last_used = time.time()
+
+    def victims(self):
+        """Remove and return expired pools, and any over capacity (w/lock)"""
+        idle = [(k, p) for k, p in self.pools.items() if p not in self.users]
+        now = time.time()
+        victims = [(k, p) for k, p in idle if p.expires(self.ttl) < now]
+        excess = len(self.pools) - len(victims) - self.capacity()
+        if excess > 0:
+            idle = [(k, p) for k, p in idle if p.expires(self.ttl) >= now]
+            idle.sort(key=lambda item: item[0][0] in plan.batch)  # stable sort
+            victims.extend(idle[:excess])
+            self.evicted.update(key for key, pool in idle[:excess])
+        for key, pool in victims:
+            del self.pools[key]
+        return victims
+
+    def close(self, victims):
+        """Close the connections of pools removed from the cache"""
+        for key, pool in victims:
+            stats.record('cache_evict', key[0])
+            pool.close()
+
+    def replan(self):
+        """Evict unreachable hosts, and resize to fit the runner's plan"""
+        with self.lock:
+            victims = [
+                (k, p) for k, p in self.pools.items()
+                if k[0] in plan.dropped and p not in self.users
+            ]
+            for key, pool in victims:
+                del self.pools[key]
+            victims.extend(self.victims())
+        self.close(victims)
+
+    def sweep(self, interval):
+        """Drop dead connections, and pools that have expired or emptied
+
+        Unexpired idle pools whose connections are still alive are then kept
+        until KEEPALIVE_TTL secs after their last use (see HostPool.expires).
+        """
+        with self.lock:
+            pools = self.pools.items()
+        for key, pool in pools:
+            alive = pool.sweep(interval)
+            with self.lock:
+                if self.pools.get(key) is not pool or pool in self.users:
+                    continue
+                if not alive:
+                    del self.pools[key]
+                elif pool.expires(self.ttl) >= time.time():
+                    pool.kept_alive = time.time()   # keep it until KEEPALIVE_TTL
+        with self.lock:
+            victims = self.victims()
+        self.close(victims)
+
+    def start_sweeper(self, interval):
+        """Start a daemon thread that calls sweep() every `interval` secs"""
+        def run(sleep=time.sleep):
+            while True:
+                sleep(interval)
+                if time is None:
+                    return  # this module was torn down at interpreter exit
+                try:
+                    self.sweep(interval)
+                except Exception:
+                    traceback.print_exc()
+        self.sweeper = Thread(target=run, name='paramiko_pool keepalive')
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+SSH_CONNECTION_CACHE = ConnectionCache(CACHE_SIZE, TTL)
+plan.listeners.append(SSH_CONNECTION_CACHE.replan)
+
+KNOWN_HOSTS = os.path.expanduser("~/.ssh/known_hosts")
+
+class HostKeyStore(object):
+    """Host keys shared by all of a process' clients, and saved at exit
+
+    known_hosts is read once (instead of by every new client), and the keys
+    accepted during the run go in `added`, which every client shares, so
+    other connections don't ask about them again.  They're then appended to
+    known_hosts with a single atomic rewrite when the process exits.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.known = self.added = None
+
+    def attach(self, ssh, runner):
+        """Make `ssh` (a new SSHClient) use the shared keys"""
+        with self.lock:
+            if self.added is None:
+                self.known, self.added = paramiko.HostKeys(), paramiko.HostKeys()
+                if C.HOST_KEY_CHECKING and os.path.exists(KNOWN_HOSTS):
+                    self.known.load(KNOWN_HOSTS)
+        ssh._system_host_keys, ssh._host_keys = self.known, self.added
+        ssh.set_missing_host_key_policy(HostKeyPolicy(runner))
+
+    def save(self):
+        """Add new keys to known_hosts (if configured to), in one write"""
+        if not (self.added and C.HOST_KEY_CHECKING and C.PARAMIKO_RECORD_HOST_KEYS):
+            return
+        dirname = os.path.dirname(KNOWN_HOSTS)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, ".known_hosts.lock"), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                # Re-read it, in case another process added keys since
+                current, text, mode = paramiko.HostKeys(), '', 0644
+                if os.path.exists(KNOWN_HOSTS):
+                    current.load(KNOWN_HOSTS)
+                    mode = os.stat(KNOWN_HOSTS).st_mode & 0777
+                    with open(KNOWN_HOSTS) as f:
+                        text = f.read()
+                lines = [
+                    "%s %s %s\n" % (hostname, keytype, key.get_base64())
+                    for hostname, keys in self.added.items()
+                    for keytype, key in keys.items()
+                    if not current.check(hostname, key)
+                ]
+                if lines:
+                    if text and not text.endswith('\n'):
+                        text += '\n'
+                    fd, tmp = tempfile.mkstemp(dir=dirname)
+                    with os.fdopen(fd, 'w') as f:
+                        f.write(text + ''.join(lines))
+                    os.chmod(tmp, mode)
+                    os.rename(tmp, KNOWN_HOSTS)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    def after_fork(self):
+        self.added = None   # the parent will save its own
+        util.Finalize(self, HostKeyStore.save, (self,), exitpriority=1)
+
+class HostKeyPolicy(MyAddPolicy):
+    """Ansible's add/prompt policy, minus repeats for already-accepted keys"""
+
+    def missing_host_key(self, client, hostname, key):
+        with HOST_KEYS.lock:
+            if not client._host_keys.check(hostname, key):
+                MyAddPolicy.missing_host_key(self, client, hostname, key)
+
+HOST_KEYS = HostKeyStore()
+util.Finalize(HOST_KEYS, HostKeyStore.save, (HOST_KEYS,), exitpriority=1)
+util.register_after_fork(HOST_KEYS, HostKeyStore.after_fork)
+
+class Pipeline(object):
+    """Client wrapper that feeds `in_data` to the next session's stdin
+
+    It stands in for the client, its transport, and the opened channel, so
+    that the base class' exec_command() can be reused as-is.
+    """
+
+    def __init__(self, ssh, in_data):
+        self.ssh, self.in_data, self.chan = ssh, in_data, None
+
+    def get_transport(self):
+        return self
+
+    def set_keepalive(self, interval):
+        self.ssh.get_transport().set_keepalive(interval)
 
-    def put(self, conn):
-        """Save a connection as recently used"""
-        self[conn.host, conn.port, conn.user] = conn.ssh
+    def open_session(self):
+        self.chan = self.ssh.get_transport().open_session()
+        return self
+
+    def __getattr__(self, attr):
+        return getattr(self.chan, attr)
 
-SSH_CONNECTION_CACHE = ConnectionCache(CACHE_SIZE, TTL) 
+    def get_pty(self, *args, **kw):
+        pass    # a pty would echo the module source back to us
+
+    def makefile(self, *args):
+        if self.in_data is not None:
+            # The command's been started, so send the module and an EOF
+            self.chan.sendall(self.in_data)
+            self.chan.shutdown_write()
+            self.in_data = None
+        return self.chan.makefile(*args)
 
 
 
 class Connection(Base):
 
+    ssh = sftp = pool = None
+    pipelining_configured = True    # has_pipelining includes the setting
+
+    def __init__(self, runner, *args, **kw):
+        Base.__init__(self, runner, *args, **kw)
+        # Without a pty, there's no way to answer a sudo/su password prompt
+        self.has_pipelining = C.POOLED_PIPELINING and not (
+            runner.sudo_pass or runner.su_pass
+        )
+
     def connect(self):
-        self.ssh = SSH_CONNECTION_CACHE.get(self)
+        if self.pool is None:
+            self.pool, self.ssh = SSH_CONNECTION_CACHE.checkout(self)
         return self
 
     def close(self):
-        Base.close(self)
+        """Check our client back into the pool (HOST_KEYS saves new keys)"""
+        if self.pool is not None:
+            if self.sftp is not None:
+                self.pool.checkin_sftp(self.ssh, self.sftp)
+                self.sftp = None
+            SSH_CONNECTION_CACHE.checkin(self, self.pool, self.ssh)
+            self.pool = None
+
+    def _connect_uncached(self):
+        """Open a new client, using the process' shared host keys"""
+        vvv("ESTABLISH CONNECTION FOR USER: %s on PORT %s TO %s" % (
+            self.user, self.port, self.host), host=self.host)
+        ssh = paramiko.SSHClient()
+        HOST_KEYS.attach(ssh, self.runner)
+        key_filename = self.private_key_file or self.runner.private_key_file
+        try:
+            ssh.connect(self.host, username=self.user,
+                allow_agent=self.password is None, look_for_keys=True,
+                key_filename=key_filename and os.path.expanduser(key_filename),
+                password=self.password, timeout=self.runner.timeout,
+                port=self.port
+            )
+        except Exception, e:
+            msg = str(e)
+            if "PID check failed" in msg:
+                raise errors.AnsibleError("paramiko version issue, please upgrade paramiko on the machine running ansible")
+            elif "Private key file is encrypted" in msg:
+                msg = 'ssh %s@%s:%s : %s\nTo connect as a different user, use -u <username>.' % (
+                    self.user, self.host, self.port, msg)
+            raise errors.AnsibleConnectionFailed(msg)
+        return ssh
 
-        # Don't re-write the hosts file after every command!
-        for hostname, keys in self.ssh._host_keys.iteritems():
-            for keytype, key in keys.iteritems():
-                key._added_by_ansible_this_time = False
+    def exec_command(self, cmd, tmp_path, sudo_user=None, sudoable=False,
+                     executable='/bin/sh', in_data=None, su=None, su_user=None):
+        """Run a command, piping `in_data` (e.g. a module) to its stdin"""
+        ssh = self.ssh
+        if in_data:
+            self.ssh = Pipeline(ssh, in_data)
+        try:
+            return Base.exec_command(self, cmd, tmp_path, sudo_user, sudoable,
+                                     executable, None, su, su_user)
+        finally:
+            self.ssh = ssh
+
+    def _sftp(self):
+        """Return an SFTP session from the pool, held until close()"""
+        if self.sftp is None:
+            try:
+                self.sftp = self.pool.checkout_sftp(self.ssh)
+            except Exception, e:
+                raise errors.AnsibleError(
+                    "failed to open a SFTP connection (%s)" % e
+                )
+        return self.sftp
+
+    def put_file(self, in_path, out_path):
+        """Upload a file, or copy it from the host's upload cache"""
+        uploads.put_file(self, in_path, out_path, self._upload)
+
+    def _upload(self, in_path, out_path):
+        """Upload from a memory map, in large pipelined (unacknowledged) writes"""
+        vvv("PUT %s TO %s" % (in_path, out_path), host=self.host)
+        if not os.path.exists(in_path):
+            raise errors.AnsibleFileNotFound(
+                "file or module does not exist: %s" % in_path
+            )
+        sftp = self._sftp()
+        try:
+            with open(in_path, 'rb') as src:
+                size = os.fstat(src.fileno()).st_size
+                dst = sftp.open(out_path, 'wb')
+                try:
+                    dst.set_pipelined(True)
+                    if size:    # can't mmap an empty file
+                        data = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+                        try:
+                            for pos in xrange(0, size, TRANSFER_CHUNK):
+                                dst.write(data[pos:pos+TRANSFER_CHUNK])
+                        finally:
+                            data.close()
+                finally:
+                    dst.close()     # waits for any outstanding writes
+        except IOError:
+            raise errors.AnsibleError("failed to transfer file to %s" % out_path)
+
+    def fetch_file(self, in_path, out_path):
+        """Download w/prefetched (pipelined) reads, straight to the local file"""
+        vvv("FETCH %s TO %s" % (in_path, out_path), host=self.host)
+        sftp = self._sftp()
+        try:
+            src = sftp.open(in_path, 'rb')
+            try:
+                src.prefetch()
+                with open(out_path, 'wb') as dst:
+                    while True:
+                        data = src.read(TRANSFER_CHUNK)
+                        if not data:
+                            break
+                        dst.write(data)
+            finally:
+                src.close()
+        except IOError:
+            raise errors.AnsibleError("failed to transfer file from %s" % in_path)
 
-        # Mark connection as recently used
-        SSH_CONNECTION_CACHE.put(self)
 
 
 
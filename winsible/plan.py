@@ -0,0 +1,28 @@
+"""What the runner is working on, for transports that cache connections
+
+Before each task, the runner injection calls update() with the addresses of
+the hosts the task will run on, and afterwards with the addresses of any that
+turned out to be unreachable.  Connection caches add a callable to
+`listeners` to be told of each change.  (In `pool` mode, the updates are also
+forwarded to the pool process(es), where the connections actually live; a
+pool daemon combines the plans of all the runs attached to it.)
+"""
+
+batch = frozenset()     # addresses of the current task's hosts
+dropped = frozenset()   # addresses found unreachable by the last task
+host_count = 0          # number of hosts in the inventory (0 = unknown)
+forks = 0               # the runner's `forks` setting (0 = unknown)
+
+listeners = []
+
+def update(new_batch, new_dropped=(), new_host_count=0, new_forks=0):
+    """Replace the current plan, and notify listeners"""
+    global batch, dropped, host_count, forks
+    batch, dropped = frozenset(new_batch), frozenset(new_dropped)
+    host_count, forks = new_host_count, new_forks
+    for listener in listeners:
+        listener()
+
+def current():
+    """Return the current plan, as arguments for update()"""
+    return sorted(batch), sorted(dropped), host_count, forks
@@ -1,16 +1,30 @@
 import os, re, subprocess, ansible.utils, ansible.errors, ansible.constants as C
+import sys, time, hmac, pipes, cPickle
+from base64 import b64decode
+from fnmatch import fnmatch
+from hashlib import md5, sha1
 from fcntl import fcntl, F_SETFL, F_GETFL
 from select import select
 from ansible.callbacks import vvv
-from ansible.errors import AnsibleError
+from ansible.errors import AnsibleError, AnsibleConnectionFailed
 from ansible.runner.connection_plugins.ssh import Connection as SSHBase
 from multiprocessing.util import Finalize
+from threading import RLock
+from cachetools import LRUCache
+from winsible import stats, uploads
 
 EXE_PATH = os.path.dirname(
     os.path.realpath(__file__ if __file__.endswith('.py') else __file__[:-1])
 )
 
+PERSISTENT_CHANNELS = C.get_config(C.p, 'plink_connection',
+    'persistent_channels', 'ANSIBLE_PLINK_PERSISTENT_CHANNELS', True,
+    boolean=True
+)
+
 conn_cache = {}
+master_locks = {}
+channels = {}   # base command -> Channel (or False if it couldn't start)
 
 def reap(proc):
     try:
@@ -22,6 +36,10 @@ def reap(proc):
     proc.communicate()
 
 def cleanup_cached_connections():
+    while channels:
+        (cmd, chan) = channels.popitem()
+        if chan:
+            chan.close()
     while conn_cache:
         (cmd, (proc, err, fail)) = conn_cache.popitem()
         if proc.poll() is None:
@@ -31,12 +49,287 @@ Finalize(None, cleanup_cached_connections, exitpriority=-1)
 def shout(cmd):
     process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     output, unused_err = process.communicate()
-    if process.poll():
+    retcode = process.poll()
+    if retcode:
         raise subprocess.CalledProcessError(retcode, cmd[0], output=output)
     return output
 
-def cygpath(path):
-    return shout(['cygpath','-wa',path])[:-1]
+class PathTranslator(object):
+    """Cygwin-to-Windows path translation, without a process per path
+
+    Translations are memoized.  Normalized paths under a mount point from
+    /proc/mounts are translated directly; anything else (e.g. paths through
+    symlinks, or with characters Cygwin maps specially) is sent to a
+    long-running `cygpath -f -` process, falling back to running `cygpath`
+    once per path if that process doesn't respond.
+    """
+
+    SAFE = re.compile(r'[\w./ +@~-]*$').match
+
+    def __init__(self, size=1024):
+        self.cache = LRUCache(size)
+        self.lock = RLock()
+        self.mounts = self.read_mounts()
+        self.coprocess = self.pid = None
+
+    @staticmethod
+    def read_mounts(path='/proc/mounts'):
+        """Return [(mount_point, windows_path)], longest mount point first"""
+        mounts = []
+        try:
+            lines = open(path).readlines()
+        except IOError:
+            return mounts
+        for line in lines:
+            fields = [f.replace('\\040', ' ') for f in line.split()]
+            if len(fields) > 1 and re.match('[A-Za-z]:', fields[0]):
+                mounts.append(
+                    (fields[1].rstrip('/'), fields[0].replace('/', '\\'))
+                )
+        mounts.sort(key=lambda m: len(m[0]), reverse=True)
+        return mounts
+
+    def __getitem__(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            try:
+                return self.cache[path]
+            except KeyError:
+                result = self.cache[path] = \
+                    self.from_mounts(path) or self.from_cygpath(path)
+                return result
+
+    def from_mounts(self, path):
+        """Translate via the mount table, or return None if it's not safe"""
+        parent = os.path.dirname(path)
+        if not self.SAFE(path) or os.path.realpath(parent) != parent:
+            return None
+        for mount_point, windows_path in self.mounts:
+            if path == mount_point or path.startswith(mount_point + '/'):
+                result = windows_path.rstrip('\\') + \
+                    path[len(mount_point):].replace('/', '\\')
+                return result + '\\' if result.endswith(':') else result
+
+    def from_cygpath(self, path):
+        """Translate using the `cygpath` coprocess, or a one-off `cygpath`"""
+        if self.pid != os.getpid():
+            # don't share a parent process' pipes
+            self.pid, self.coprocess = os.getpid(), subprocess.Popen(
+                ['cygpath', '-wa', '-f', '-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+        proc = self.coprocess
+        if proc is not None and '\n' not in path:
+            proc.stdin.write(path + '\n')
+            proc.stdin.flush()
+            if proc.stdout in select([proc.stdout], [], [], 5)[0]:
+                result = proc.stdout.readline()
+                if result:
+                    return result[:-1]
+            reap(proc)      # unresponsive (or buffering): stop using it
+            self.coprocess = None
+        return shout(['cygpath','-wa',path])[:-1]
+
+cygpath = PathTranslator().__getitem__
+
+
+# Remote end of a Channel: runs framed requests from stdin, one at a time.
+# Requests are "op size\n" + size bytes of NUL-separated arguments, and
+# replies are "rc outsize errsize\n" + the output and error bytes.  File
+# contents are streamed as "size\n" + size bytes frames, ending with "0\n":
+# after a put's request, and before a fetch's reply.  While a command runs,
+# the server sends a blank line every second, so the client can tell a slow
+# command from a hung server.
+CHANNEL_SERVER = r'''
+import sys, subprocess, threading
+i = getattr(sys.stdin, 'buffer', sys.stdin)
+o = getattr(sys.stdout, 'buffer', sys.stdout)
+lock = threading.Lock()
+def send(*data):
+    lock.acquire()
+    try:
+        for d in data: o.write(d)
+        o.flush()
+    finally:
+        lock.release()
+def reply(rc, out, err):
+    send(('%d %d %d\n' % (rc, len(out), len(err))).encode(), out, err)
+def error():
+    return str(sys.exc_info()[1]).encode()
+def chunks():
+    while 1:
+        size = int(i.readline())
+        if not size: break
+        yield i.read(size)
+def beat(done):
+    while not done.is_set():
+        done.wait(1)
+        if not done.is_set(): send(b'\n')
+reply(0, b'', b'')
+while 1:
+    head = i.readline().split()
+    if not head:
+        break
+    op, args = head[0], i.read(int(head[1])).split(b'\0')
+    try:
+        if op == b'exec':
+            p = subprocess.Popen(args[0], shell=True, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            done = threading.Event()
+            t = threading.Thread(target=beat, args=(done,))
+            t.daemon = True; t.start()
+            try:
+                out, err = p.communicate(b'\0'.join(args[1:]))
+            finally:
+                done.set(); t.join()
+            reply(p.returncode, out, err)
+        elif op == b'put':
+            err = b''
+            try:
+                f = open(args[0], 'wb')
+            except Exception:
+                f, err = None, error()
+            for data in chunks():
+                try:
+                    if f: f.write(data)
+                except Exception:
+                    err = error()
+                    try: f.close()
+                    except Exception: pass
+                    f = None
+            if f: f.close()
+            reply(err and 1 or 0, b'', err)
+        elif op == b'fetch':
+            err = b''
+            try:
+                f = open(args[0], 'rb')
+                try:
+                    data = f.read(65536)
+                    while data:
+                        send(('%d\n' % len(data)).encode(), data)
+                        data = f.read(65536)
+                finally:
+                    f.close()
+            except Exception:
+                err = error()
+            send(b'0\n')
+            reply(err and 1 or 0, b'', err)
+    except Exception:
+        reply(1, b'', error())
+'''
+
+CHUNK = 65536   # bytes per file frame sent to a channel
+
+class ChannelError(Exception):
+    """The channel failed before a request was sent, so it can be retried"""
+
+class Channel(object):
+    """A long-running plink process that runs commands and transfers files
+
+    The remote side is a small Python loop (CHANNEL_SERVER) that reads
+    framed requests from stdin, so each command or transfer costs a
+    request/reply over an existing (shared) connection, instead of a new
+    plink, pscp, or psftp process.  If the server is silent for `timeout`
+    seconds, the channel is closed and AnsibleConnectionFailed is raised.
+    """
+
+    def __init__(self, base_command, timeout):
+        self.pid = os.getpid()
+        self.lock = RLock()
+        self.timeout = timeout
+        self.buf = ''
+        self.proc = subprocess.Popen(
+            base_command + ['-T',
+                'python -u -c "import sys;exec(eval(sys.stdin.readline()))"'
+            ],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w')
+        )
+        self.send(repr(CHANNEL_SERVER) + '\n')
+        self.reply()    # the server says hello once it's running
+
+    def send(self, *data):
+        try:
+            for d in data:
+                self.proc.stdin.write(d)
+            self.proc.stdin.flush()
+        except (IOError, OSError), e:
+            raise ChannelError(str(e))
+
+    def request(self, op, *args):
+        """Send a request (without waiting for the reply)"""
+        data = '\0'.join(args)
+        self.send('%s %d\n' % (op, len(data)), data)
+
+    def run(self, cmd, in_data):
+        """Run `cmd` with `in_data` as its input, returning (rc, out, err)"""
+        self.request('exec', cmd, in_data)
+        return self.reply()
+
+    def put(self, path, f):
+        """Write file `f`'s contents to `path`, returning (rc, '', err)"""
+        self.request('put', path)
+        while True:
+            data = f.read(CHUNK)
+            self.send('%d\n' % len(data), data)
+            if not data:
+                return self.reply()
+
+    def fetch(self, path, f):
+        """Write `path`'s contents to file `f`, returning (rc, '', err)"""
+        self.request('fetch', path)
+        while True:
+            size, = self.header(1)
+            if not size:
+                return self.reply()
+            f.write(self.read(size))
+
+    def reply(self):
+        rc, out, err = self.header(3)
+        return rc, self.read(out), self.read(err)
+
+    def header(self, fields):
+        """Read a line of `fields` integers, skipping heartbeats"""
+        line = ''
+        while not line:
+            while '\n' not in self.buf:
+                self.buf += self.recv()
+            line, self.buf = self.buf.split('\n', 1)
+        try:
+            head = map(int, line.split())
+        except ValueError:
+            head = []
+        if len(head) != fields:
+            self.close()
+            raise AnsibleError("plink channel closed unexpectedly")
+        return head
+
+    def read(self, size):
+        parts, have = [self.buf], len(self.buf)
+        while have < size:
+            parts.append(self.recv())
+            have += len(parts[-1])
+        data = ''.join(parts)
+        self.buf = data[size:]
+        return data[:size]
+
+    def recv(self):
+        """Return the next output from the server, waiting up to `timeout`"""
+        fd = self.proc.stdout.fileno()
+        if not select([fd], [], [], self.timeout)[0]:
+            self.close()
+            raise AnsibleConnectionFailed(
+                "plink channel timed out after %s seconds" % self.timeout
+            )
+        data = os.read(fd, CHUNK)
+        if not data:
+            self.close()
+            raise AnsibleError("plink channel closed unexpectedly")
+        return data
+
+    def close(self):
+        if self.proc.poll() is None:
+            reap(self.proc)
 
 
 fingerprints = {}
@@ -44,32 +337,217 @@ fingerprints = {}
 FAILED = re.compile(r'Access denied|FATAL ERROR|Fatal: ').search
 SUCCESS = re.compile(r'Access granted|Reusing a shared connection').search
 
-def get_ssh_key(hostinfo, path=None):
-    """Look up a key fingerprint from a single known_hosts file"""
-    cmd = ['ssh-keygen', '-F', hostinfo, '-l']
-    if path:
-        if not os.path.exists(path):
+KNOWN_HOSTS = [
+    os.path.expanduser("~/.ssh/known_hosts"),
+    "/etc/ssh/ssh_known_hosts", "/etc/ssh/ssh_known_hosts2",
+]
+KNOWN_HOSTS_CACHE = os.path.expanduser("~/.ansible/winsible_known_hosts.cache")
+
+def key_fingerprint(blob):
+    """Return a public key's MD5 fingerprint, in aa:bb:cc... format"""
+    return re.sub('(..)(?!$)', '\\1:', md5(blob).hexdigest())
+
+class KnownHosts(object):
+    """Index of the host key fingerprints in a series of known_hosts files
+
+    Entries are kept in file order, so the first matching entry wins.  Plain
+    hostnames are indexed by name, while hashed (|1|salt|hash) and wildcard
+    entries have to be checked one at a time.  The parsed index is cached in
+    `cache`, and only re-parsed when one of the files changes.
+    """
+
+    def __init__(self, paths=KNOWN_HOSTS, cache=KNOWN_HOSTS_CACHE):
+        stamp = [self.stamp(path) for path in paths]
+        try:
+            with open(cache, 'rb') as f:
+                data = cPickle.load(f)
+            if data[0] != stamp:
+                raise ValueError("stale cache")
+        except Exception:
+            data = (stamp,) + self.parse(paths)
+            self.save(cache, data)
+        stamp, self.plain, self.hashed, self.patterns = data
+
+    @staticmethod
+    def stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
             return None
-        cmd.extend(['-f', path])
-    for line in shout(cmd).splitlines():
-        if line.startswith('#'): continue
-        fields = line.split()
-        if len(fields)>2:
-            return fields[1]
+        return st.st_mtime, st.st_size
+
+    @staticmethod
+    def parse(paths):
+        """Return (plain, hashed, patterns) indexes of `paths`' entries"""
+        plain, hashed, patterns = {}, [], []
+        order = 0
+        for path in paths:
+            try:
+                lines = open(path).readlines()
+            except IOError:
+                continue
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 3 or fields[0][:1] in '#@':
+                    continue    # skip comments, @cert-authority, and @revoked
+                try:
+                    fp = key_fingerprint(b64decode(fields[2]))
+                except (TypeError, ValueError):
+                    continue
+                order += 1
+                names = fields[0].split(',')
+                if names[0].startswith('|1|'):
+                    try:
+                        salt, digest = map(b64decode, names[0][3:].split('|'))
+                    except (TypeError, ValueError):
+                        continue    # malformed; skip it, as OpenSSH does
+                    hashed.append((order, salt, digest, fp))
+                elif [n for n in names if n[:1]=='!' or '*' in n or '?' in n]:
+                    patterns.append((order, names, fp))
+                else:
+                    for name in names:
+                        plain.setdefault(name, (order, fp))
+        return plain, hashed, patterns
+
+    @staticmethod
+    def save(cache, data):
+        """Atomically replace the cache file, ignoring errors"""
+        tmp = '%s.%d' % (cache, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            with open(tmp, 'wb') as f:
+                cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, cache)
+        except (IOError, OSError):
+            pass
+
+    def __getitem__(self, host):
+        """Return the fingerprint for `host` (or "[host]:port"), or None"""
+        best = self.plain.get(host, (sys.maxint, None))
+        for order, salt, digest, fp in self.hashed:
+            if order > best[0]:
+                break
+            if hmac.new(salt, host, sha1).digest() == digest:
+                best = order, fp
+                break
+        for order, names, fp in self.patterns:
+            if order > best[0]:
+                break
+            yes = [fnmatch(host, n) for n in names if n[:1]!='!']
+            no = [fnmatch(host, n[1:]) for n in names if n[:1]=='!']
+            if any(yes) and not any(no):
+                best = order, fp
+                break
+        return best[1]
+
+known_hosts = None
 
 def get_fingerprint(host, port, default=lambda h: None):
     """Find a cached key fingerprint for a given host/port"""
+    global known_hosts
     if port != 22:
         host = '[%s]:%d' % (host, port)
     try:
         return fingerprints[host]
     except KeyError:
-        f = fingerprints[host] = get_ssh_key(host) or \
-            get_ssh_key(host, "/etc/ssh/ssh_known_hosts") or \
-            get_ssh_key(host, "/etc/ssh/ssh_known_hosts2") or \
-            default(host)
+        if known_hosts is None:
+            known_hosts = KnownHosts()
+        f = fingerprints[host] = known_hosts[host] or default(host)
         return f
 
+class MasterStartup(object):
+    """Incrementally check a starting plink master's output for the result"""
+
+    failed = None   # becomes True or False once the outcome is known
+    failing = False # an error was seen; read the rest until it exits
+
+    def __init__(self, proc):
+        self.proc, self.chunks, self.partial = proc, [], ''
+        self.start = self.last = time.time()
+        fd = proc.stderr
+        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | os.O_NONBLOCK)
+
+    def feed(self):
+        """Read available output, checking only the newly-completed lines"""
+        data = os.read(self.proc.stderr.fileno(), 5000)
+        self.last = time.time()
+        if not data:
+            self.proc.wait()
+            self.failed = True
+            return
+        self.chunks.append(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if FAILED(line):
+                self.failing = True
+            elif SUCCESS(line) and not self.failing:
+                self.failed = False
+                return
+
+    def time_out(self):
+        reap(self.proc)
+        self.chunks.append('\nTimeout during master connection\n')
+        self.failed = True
+
+    def output(self):
+        return ''.join(self.chunks)
+
+def wait_for_masters(startups, timeout):
+    """Wait for starting masters to succeed, fail, or time out, all at once"""
+    pending = dict((s.proc.stderr.fileno(), s) for s in startups)
+    while pending:
+        now = time.time()
+        for fd, startup in pending.items():
+            if now - startup.last >= timeout:
+                startup.time_out()
+                del pending[fd]
+        if pending:
+            wait = min(s.last for s in pending.values()) + timeout - now
+            r, w, e = select(pending.keys(), [], [], max(0, wait))
+            for fd in r:
+                pending[fd].feed()
+                if pending[fd].failed is not None:
+                    del pending[fd]
+
+def connect_masters(conns):
+    """Return (proc, output, failed) master info for each of `conns`
+
+    Any masters that aren't already running are started together, and
+    awaited in a single select() loop, so that many hosts' connections can
+    be established in parallel.
+    """
+    cmds = [conn.master_command() for conn in conns]
+    # Only start one master per command, even if tasks run in threads
+    # (Locks are taken in sorted order, to avoid deadlocking other callers)
+    locks = [master_locks.setdefault(cmd, RLock()) for cmd in sorted(set(cmds))]
+    for lock in locks:
+        lock.acquire()
+    try:
+        startups = {}
+        for conn, cmd in zip(conns, cmds):
+            if cmd not in conn_cache and cmd not in startups:
+                #print "CONNECTION UP:", ' '.join(cmd)
+                vvv("ESTABLISH PLINK FOR USER: %s" % conn.user, host=conn.host)
+                (proc, stdin) = SSHBase._run(conn, cmd, True)
+                startups[cmd] = MasterStartup(proc)
+                startups[cmd].host = conn.host
+        if startups:
+            wait_for_masters(
+                startups.values(), max(conn.runner.timeout for conn in conns)
+            )
+        results = {}
+        for cmd, startup in startups.items():
+            stats.record('master_setup', startup.host, startup.last-startup.start)
+            results[cmd] = startup.proc, startup.output(), startup.failed
+            if startup.proc.poll() is None:
+                conn_cache[cmd] = results[cmd]
+        return [conn_cache.get(cmd) or results[cmd] for cmd in cmds]
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
 # Make sure executables are executable
 for exe in ['plink', 'putty', 'pscp', 'psftp']:
     try:
@@ -82,8 +560,11 @@ for exe in ['plink', 'putty', 'pscp', 'psftp']:
 
 class Connection(SSHBase):
 
+    pipelining_configured = True    # has_pipelining includes the setting
+
     def __init__(self, *args, **kwargs):
         SSHBase.__init__(self, *args, **kwargs)
+        self.has_pipelining = C.POOLED_PIPELINING
         self.port = (C.DEFAULT_REMOTE_PORT or 22) if self.port is None else self.port
 
     def connect(self):
@@ -123,8 +604,6 @@ class Connection(SSHBase):
 
     def fetch_hostkey(self, hkey):
         from ansible.runner.connection_plugins.paramiko_ssh import Connection
-        from hashlib import md5
-        import re
         paramiko = Connection(
             self.runner, self.host, self.port, self.user, self.password,
             self.private_key_file
@@ -132,7 +611,7 @@ class Connection(SSHBase):
         paramiko.connect()
         try:
             for ktyp, key in paramiko.ssh._host_keys.get(hkey, {}).iteritems():
-                return re.sub('(..)(?!$)', '\\1:', md5(key.asbytes()).hexdigest())
+                return key_fingerprint(key.asbytes())
         finally:
             paramiko.close()
 
@@ -162,43 +641,78 @@ class Connection(SSHBase):
 
 
 
+    def master_command(self):
+        return tuple(self._base_command()+['-v', '-N'])
+
     def connect_master(self):
-        cmd = tuple(self._base_command()+['-v', '-N'])
-        try:
-            return conn_cache[cmd]
-        except KeyError:
-            #print "CONNECTION UP:", ' '.join(cmd)
-            vvv("ESTABLISH PLINK FOR USER: %s" % self.user, host=self.host)
-            (proc, stdin) = SSHBase._run(self, cmd, True)
-            err_output, fail = self._wait_for_master(proc)
-            if proc.poll() is None:
-                conn_cache[cmd] = proc, err_output, fail
-        return proc, err_output, fail
-
-    def exec_command(self, cmd, *args, **kw):
+        return connect_masters([self])[0]
+
+    def preconnect(self):
+        """Start (and cache) the master connection ahead of time"""
+        self.connect_master()
+
+    @classmethod
+    def preconnect_all(cls, conns):
+        """Start (and cache) the master connections of `conns` together"""
+        connect_masters(conns)
+
+    def exec_command(self, cmd, tmp_path, sudo_user=None, sudoable=False,
+                     executable='/bin/sh', in_data=None, su=None, su_user=None):
         proc, err_output, fail = self.connect_master()
         ret = proc.poll()
         if ret is not None:
             return (255 if fail else ret), '', err_output, err_output
-        return SSHBase.exec_command(self, cmd, *args, **kw)
 
-    def _wait_for_master(self, proc):
-        fd = proc.stderr
-        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | os.O_NONBLOCK)
-        output = ''
-        while True:
-            r, w, e = select([fd], [], [], self.runner.timeout)
-            if fd in r:
-                data = os.read(fd.fileno(), 5000)
-                output += data
-                if not data or FAILED(output):
-                    o, e = proc.communicate()
-                    return output + e, True
-                elif SUCCESS(output):
-                    return output, False
-            else:
-                reap(proc)
-                return output+'\nTimeout during master connection\n', True
+        if su and su_user:
+            remote_cmd = None   # su always prompts for a password
+        elif not self.runner.sudo or not sudoable:
+            remote_cmd = executable + ' -c ' + pipes.quote(cmd) \
+                if executable else cmd
+        elif in_data and not self.runner.sudo_pass:
+            remote_cmd = ansible.utils.make_sudo_cmd(
+                self.runner.sudo_exe, sudo_user, executable, cmd
+            )[0]
+        else:
+            # Like _run(), give sudo a pty unless the command is pipelined,
+            # to answer a password prompt or satisfy `requiretty`
+            remote_cmd = None
+
+        if remote_cmd is not None:
+            vvv("EXEC (channel) %s" % remote_cmd, host=self.host)
+            res = self._via_channel('run', remote_cmd, in_data or '')
+            if res is not None:
+                rc, out, err = res
+                return rc, '', out, err
+
+        return SSHBase.exec_command(self, cmd, tmp_path, sudo_user, sudoable,
+                                    executable, in_data, su, su_user)
+
+    def _via_channel(self, method, *args):
+        """Call a channel `method`, or return None if no channel is free"""
+        if not PERSISTENT_CHANNELS:
+            return None
+        key = tuple(self._base_command())
+        with master_locks.setdefault(key, RLock()):
+            chan = channels.get(key)
+            if chan is None or chan and chan.pid != os.getpid():
+                try:
+                    chan = Channel(list(key), self.runner.timeout)
+                except (ChannelError, AnsibleError, IOError, OSError):
+                    chan = False    # e.g. no python; don't try again
+                channels[key] = chan
+        if not chan or not chan.lock.acquire(False):
+            return None     # no channel, or another task is using it
+        try:
+            return getattr(chan, method)(*args)
+        except ChannelError:
+            chan.close()
+            channels.pop(key, None)
+            return None
+        except AnsibleError:
+            channels.pop(key, None)     # it's closed, e.g. by a timeout
+            raise
+        finally:
+            chan.lock.release()
 
     def _password_cmd(self):
         return []
@@ -207,6 +721,18 @@ class Connection(SSHBase):
         return
 
     def put_file(self, in_path, out_path):
+        uploads.put_file(self, in_path, out_path, self._upload)
+
+    def _upload(self, in_path, out_path):
+        if os.path.exists(in_path):
+            with open(in_path, 'rb') as f:
+                res = self._via_channel('put', out_path, f)
+            if res is not None:
+                if res[0]:
+                    raise AnsibleError(
+                        "failed to transfer file to %s: %s" % (out_path, res[2])
+                    )
+                return
         cpath = cygpath(in_path)
         cpath = cpath.replace('\\','/')
         orig_exists = os.path.exists
@@ -222,6 +748,15 @@ class Connection(SSHBase):
             os.path.exists = orig_exists
 
     def fetch_file(self, in_path, out_path):
+        with open(out_path, 'wb') as f:
+            res = self._via_channel('fetch', in_path, f)
+        if res is not None:
+            if res[0]:
+                raise AnsibleError(
+                    "failed to transfer file from %s: %s" % (in_path, res[2])
+                )
+            return
+
         out_path = cygpath(out_path)    # this uses Popen, so do it first
 
         original_popen = subprocess.Popen
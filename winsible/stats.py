@@ -0,0 +1,178 @@
+"""Per-host, per-phase timing counters for connections and tasks
+
+Timings are only kept if the `stats_file` setting (`WINSIBLE_STATS` in the
+environment) is set, in which case they're written there as JSON at the end
+of the run.  If `stats_samples` (`WINSIBLE_STATS_SAMPLES`) is also true, every
+duration is kept and written as well, so percentiles can be computed exactly
+instead of from the histogram's bucket bounds.
+
+Forked processes save their counters to a spool directory when they exit,
+and other processes (e.g. the pool) can be polled via `collectors`.
+"""
+
+import os, json, math, time, shutil, tempfile, ansible.constants as C
+from contextlib import contextmanager
+from threading import Lock
+from multiprocessing import util
+
+STATS_FILE = C.get_config(
+    C.p, C.DEFAULTS, 'stats_file', 'WINSIBLE_STATS', None
+)
+
+SAMPLES = C.get_config(
+    C.p, C.DEFAULTS, 'stats_samples', 'WINSIBLE_STATS_SAMPLES', False,
+    boolean=True
+)
+
+enabled = bool(STATS_FILE)
+
+data = {}   # phase -> host -> [count, total, max, {bucket: n}, [secs, ...]]
+lock = Lock()
+collectors = [] # callables returning (and resetting) other processes' data
+SPOOL = None    # directory where forked processes save their counters
+
+def bucket(seconds):
+    """Histogram bucket: N means 2**(N-1) <= milliseconds < 2**N"""
+    return str(int(seconds * 1000).bit_length())
+
+def record(phase, host=None, seconds=None):
+    """Count an event, and its duration if given"""
+    if not enabled:
+        return
+    with lock:
+        hosts = data.setdefault(phase, {})
+        entry = hosts.get(host or '')
+        if entry is None:
+            entry = hosts[host or ''] = [0, 0.0, 0.0, {}, []]
+        entry[0] += 1
+        if seconds is not None:
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            b = bucket(seconds)
+            entry[3][b] = entry[3].get(b, 0) + 1
+            if SAMPLES:
+                entry[4].append(seconds)
+
+@contextmanager
+def timer(phase, host=None):
+    """Record the time spent in a `with` block"""
+    if not enabled:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase, host, time.time() - start)
+
+def merge(other):
+    """Add the counters from `other` to this process'"""
+    with lock:
+        for phase, hosts in other.items():
+            mine = data.setdefault(phase, {})
+            for host, (count, total, top, hist, samples) in hosts.items():
+                entry = mine.setdefault(host, [0, 0.0, 0.0, {}, []])
+                entry[0] += count
+                entry[1] += total
+                entry[2] = max(entry[2], top)
+                for b, n in hist.items():
+                    entry[3][b] = entry[3].get(b, 0) + n
+                entry[4].extend(samples)
+
+def take():
+    """Return and reset this process' counters"""
+    with lock:
+        result = dict(data)
+        data.clear()
+        return result
+
+def collect():
+    """Merge in counters saved or held by other processes; return the total"""
+    for name in os.listdir(SPOOL) if SPOOL else ():
+        path = os.path.join(SPOOL, name)
+        try:
+            with open(path) as f:
+                merge(json.load(f))
+            os.unlink(path)
+        except (IOError, OSError, ValueError):
+            pass
+    for collector in collectors:
+        try:
+            merge(collector())
+        except Exception:
+            pass    # e.g. the pool has already shut down
+    return data
+
+def percentile(hist, count, fraction):
+    """Approximate a percentile (in ms) from a histogram's bucket bounds"""
+    seen = 0
+    for b in sorted(hist, key=int):
+        seen += hist[b]
+        if seen >= count * fraction:
+            return 2 ** int(b)
+    return 0
+
+def exact(samples, fraction):
+    """Return a percentile (in ms) of `samples` (in seconds), by nearest rank"""
+    if not samples:
+        return 0
+    rank = int(math.ceil(len(samples) * fraction))
+    return sorted(samples)[max(rank, 1) - 1] * 1000
+
+def summary(stats=None):
+    """Return a list of text lines summarizing `stats` (default: collect())"""
+    stats = collect() if stats is None else stats
+    lines = ['%-16s %8s %10s %8s %8s %8s %8s' % (
+        'phase', 'count', 'total(s)', 'avg(ms)', 'p50(ms)', 'p99(ms)', 'max(ms)'
+    )]
+    for phase in sorted(stats):
+        count, total, top, hist, samples = 0, 0.0, 0.0, {}, []
+        for c, t, m, h, s in stats[phase].values():
+            count, total, top = count + c, total + t, max(top, m)
+            for b, n in h.items():
+                hist[b] = hist.get(b, 0) + n
+            samples.extend(s)
+        timed = sum(hist.values())
+        if len(samples) == timed:
+            p50, p99 = exact(samples, .5), exact(samples, .99)
+        else:
+            p50, p99 = percentile(hist, timed, .5), percentile(hist, timed, .99)
+        lines.append('%-16s %8d %10.2f %8.1f %8d %8d %8.1f' % (
+            phase, count, total, total * 1000 / (timed or 1), p50, p99,
+            top * 1000
+        ))
+    return lines
+
+def save():
+    """Save a forked process' counters to the spool, for collect()"""
+    mine = take()
+    if mine and SPOOL and os.path.isdir(SPOOL):
+        path = os.path.join(SPOOL, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(mine, f)
+        os.rename(path + '.tmp', path)
+
+def dump():
+    """Write all collected counters to STATS_FILE"""
+    result = {}
+    for phase, hosts in collect().items():
+        for host, (count, total, top, hist, samples) in hosts.items():
+            entry = result.setdefault(phase, {})[host] = dict(
+                count=count, total=total, max=top, log2_ms=hist
+            )
+            if SAMPLES:
+                entry['samples'] = samples
+    with open(STATS_FILE, 'w') as f:
+        json.dump(result, f, indent=1, sort_keys=True)
+
+def after_fork(dummy):
+    with lock:
+        data.clear()    # don't save the parent's counters twice
+    util.Finalize(None, save, exitpriority=10)
+
+if enabled:
+    SPOOL = tempfile.mkdtemp(prefix='winsible-stats-')
+    # Dump before the pool shuts down (priority 0), so it can be collected
+    util.Finalize(None, dump, exitpriority=5)
+    util.Finalize(None, shutil.rmtree, (SPOOL, True), exitpriority=-10)
+    util.register_after_fork(after_fork, after_fork)
@@ -0,0 +1,98 @@
+"""Content-addressed cache of uploaded files, on the remote hosts
+
+Without pipelining (and for modules like `copy` or `template`), ansible
+uploads a file for every task on every host, even when it's the same file
+each time.  So the pooling transports' put_file() methods call put_file()
+here, which keeps a copy of any file uploaded to a host more than once in
+`~/.ansible/winsible_cache/<sha1>` on that host, and thereafter just copies it
+into place with a remote `cp`.  (The files may be rendered templates or other
+secrets, so the directory is kept private to the remote user.)
+
+A remote `cp` costs more than uploading a small file over a fast network,
+so this is off unless `upload_cache` (`ANSIBLE_UPLOAD_CACHE`) is set to the
+number of days to keep unused files.  The first upload to each host in a run
+lists its cache (and removes expired files), so files cached by earlier runs
+are reused too.  (It's also off in `fork` mode, since its connections, and
+their records, don't outlive a task.)
+"""
+
+import os, pipes, hashlib, ansible.constants as C
+from collections import defaultdict
+from threading import Lock
+from ansible.callbacks import vvv
+from winsible import stats
+
+DAYS = C.get_config(
+    C.p, C.DEFAULTS, 'upload_cache', 'ANSIBLE_UPLOAD_CACHE', 0, integer=True
+)
+
+CACHE_DIR = '.ansible/winsible_cache'   # relative to the remote user's home
+
+class RemoteCache(object):
+    """What's known to be in one (host, port, user)'s cache directory"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.known = None               # digests in the directory, once listed
+        self.uploads = defaultdict(int) # digest -> times uploaded uncached
+
+caches = defaultdict(RemoteCache)
+
+def digest(path):
+    """Return the SHA-1 hex digest of the file at `path`"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def run(conn, cmd):
+    """Run `cmd` on `conn` (as the login user), returning (rc, stdout)"""
+    rc, stdin, stdout, stderr = conn.exec_command(cmd, None)
+    return rc, stdout
+
+def listing(conn):
+    """Create and prune `conn`'s (private) cache directory; return digests"""
+    rc, out = run(conn,
+        "mkdir -p -m 700 %s && chmod 700 %s && cd %s &&"
+        " { find . -type f -mtime +%d -exec rm -f {} + ; ls; }"
+        % (CACHE_DIR, CACHE_DIR, CACHE_DIR, DAYS)
+    )
+    return set(
+        name for name in out.split()
+        if len(name) == 40 and name.isalnum()   # skip partial uploads
+    ) if rc == 0 else set()
+
+def put_file(conn, in_path, out_path, upload):
+    """Put `in_path` at `out_path` via the host's cache, or `upload()`"""
+    if DAYS <= 0 or C.PROCESS_MODE == 'fork' or not os.path.isfile(in_path):
+        return upload(in_path, out_path)
+
+    cache = caches[conn.host, conn.port, conn.user]
+    with cache.lock:
+        if cache.known is None:
+            cache.known = listing(conn)
+    key = digest(in_path)
+    cached = CACHE_DIR + '/' + key
+    copy = 'cp %s %s && touch %s' % (cached, pipes.quote(out_path), cached)
+
+    if key in cache.known:
+        vvv("PUT %s TO %s (from cache)" % (in_path, out_path), host=conn.host)
+        if run(conn, copy)[0] == 0:
+            return stats.record('upload_cached', conn.host)
+        cache.known.discard(key)    # removed out from under us?
+
+    with cache.lock:
+        cache.uploads[key] += 1
+        first = cache.uploads[key] == 1
+    if first:
+        return upload(in_path, out_path)    # may never be needed again
+
+    # Upload under a temporary name, so other runs never see a partial file
+    partial = '%s.%d-%d' % (cached, os.getpid(), cache.uploads[key])
+    upload(in_path, partial)
+    cache_it = 'chmod 600 %s && mv %s %s' % (partial, partial, cached)
+    if run(conn, '%s && %s' % (cache_it, copy))[0] == 0:
+        cache.known.add(key)
+    else:
+        upload(in_path, out_path)